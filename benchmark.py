@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- timings of the pairing and database paths
+#
+# Plays synthetic tournaments of each size for a number of rounds, then times
+# the stages of pairing the next round: loading standings, building the edge
+# list, maxWeightMatching, and the whole swissPairings call. Results are
+# written as JSON, and can be compared against an earlier run:
+#
+#   $ ./benchmark.py --players 8 64 512 --output baseline.json
+#   $ ./benchmark.py --players 8 64 512 --baseline baseline.json
+#
+
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+
+import tournament
+from mwmatching import maxWeightMatching
+from storage import pairKey
+
+
+BACKENDS = {
+    'memory': tournament.MemoryStorage,
+    'sqlite': tournament.SQLiteStorage,
+    'postgres': tournament.Session,
+}
+
+def playRound(tournId, storage, rng):
+    """Pairs and reports one round of random results.
+
+    Players are paired greedily down the standings, which is far quicker
+    than maxWeightMatching on large fields. If that leaves players unpaired
+    the round is paired with swissPairings instead.
+    """
+    standings = tournament.playerStandings(tournId, storage, useCache=False)
+    played = storage.playedPairs(tournId)
+    results = []
+    if len(standings) % 2:
+        eligible = storage.byeEligible(tournId)
+        bye = next(player for player in reversed(standings)
+                   if player.id in eligible)
+        standings.remove(bye)
+        results.append((bye.id, None))
+    unpaired = [player.id for player in standings]
+    while unpaired:
+        player = unpaired.pop(0)
+        for k, opponent in enumerate(unpaired):
+            if pairKey(player, opponent) not in played:
+                results.append((player, unpaired.pop(k)))
+                break
+        else:
+            results = [(p[0], p[2]) for p in tournament.swissPairings(
+                tournId, storage, rng=rng, useCache=False)]
+            break
+    tournament.reportMatches(tournId, [
+        (winner, loser) if loser is None or rng.random() < 0.5
+        else (loser, winner)
+        for winner, loser in results], storage)
+
+
+def makeTournament(storage, players, rounds, rng):
+    """Registers a tournament of synthetic players and plays some rounds.
+
+    Returns:
+      The tournament's id, to be passed to dropTournament when done.
+    """
+    tournId = tournament.registerTournament(
+        'Benchmark %i players' % players, storage)
+    try:
+        tournament.registerPlayers(
+            ['Player %i' % i for i in range(players)], tournId, storage)
+        for _ in range(rounds):
+            playRound(tournId, storage, rng)
+    except Exception:
+        dropTournament(storage, tournId)
+        raise
+    return tournId
+
+
+def dropTournament(storage, tournId):
+    """Deletes a tournament made by makeTournament, with its players and
+    matches, from a PostgreSQL database. In-process backends are left alone,
+    as they go away with the storage."""
+    if not isinstance(storage, tournament.Session):
+        return
+    with storage.cursor() as cur:
+        cur.execute('SELECT player FROM tournament_players WHERE tourn = %s;',
+                    (tournId,))
+        players = [player for (player,) in cur.fetchall()]
+        cur.execute('DELETE FROM matches WHERE tourn = %s;', (tournId,))
+        cur.execute('DELETE FROM tournament_players WHERE tourn = %s;',
+                    (tournId,))
+        cur.execute('DELETE FROM players WHERE id = ANY(%s);', (players,))
+        cur.execute('DELETE FROM tournaments WHERE id = %s;', (tournId,))
+
+
+def timeCall(fn, repeat):
+    """Returns the seconds each of repeat calls of fn took."""
+    timer = timeit.default_timer
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        fn()
+        times.append(timer() - start)
+    return times
+
+
+def benchmark(storage, players, rounds, repeat=3, seed=0, maxPairing=2048,
+              strategy='global'):
+    """Times each stage of pairing a synthetic tournament.
+
+    Args:
+      storage: the storage to play the tournament in.
+      players: the number of players.
+      rounds: the number of rounds played before timing.
+      repeat: the number of times each stage is timed.
+      seed: seed of the random results and byes.
+      maxPairing: the most players to time the edges, matching and
+        swissPairings stages for. The edge list alone takes O(n^2) memory,
+        and matching O(n^3) time, so larger fields only time standings.
+      strategy: the swissPairings strategy timed.
+
+    Returns:
+      A list of dicts with keys name, players, rounds, min, median and
+      runs, times being in seconds.
+    """
+    rng = random.Random(seed)
+    rounds = min(rounds, players - 1)
+    tournId = makeTournament(storage, players, rounds, rng)
+    try:
+        return _timeStages(storage, tournId, players, rounds, repeat, seed,
+                           maxPairing, strategy)
+    finally:
+        dropTournament(storage, tournId)
+
+
+def _timeStages(storage, tournId, players, rounds, repeat, seed, maxPairing,
+                strategy):
+    """Times each stage of pairing a tournament's next round, see
+    benchmark."""
+    # The graph and matching are timed without the bye player, as
+    # swissPairings gives the bye before building the graph.
+    snapshot = tournament.roundSnapshot(tournId, storage)
+    standings = list(snapshot.standings)
+    tournament._pairBye(standings, snapshot.eligible, random.Random(seed))
+    played = snapshot.played
+
+    stages = [
+        ('standings', lambda: tournament.playerStandings(
+            tournId, storage, useCache=False)),
+    ]
+    if players <= maxPairing:
+        edges = tournament.pairingEdges(standings, played)
+        stages += [
+            ('edges', lambda: tournament.pairingEdges(standings, played)),
+            ('matching', lambda: maxWeightMatching(edges, maxcardinality=True)),
+            ('swissPairings', lambda: tournament.swissPairings(
+                tournId, storage, rng=random.Random(seed), strategy=strategy,
+                useCache=False)),
+        ]
+
+    results = []
+    for name, fn in stages:
+        times = sorted(timeCall(fn, repeat))
+        results.append({
+            'name': name,
+            'players': players,
+            'rounds': rounds,
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'runs': repeat,
+        })
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Compares results with a baseline run's.
+
+    Args:
+      results, baseline: lists of result dicts, as benchmark returns.
+      tolerance: the fraction a stage may slow down by before it counts as
+        a regression.
+
+    Returns:
+      A list of (result, ratio, regressed) tuples, ratio being the result's
+      min time over the baseline's, for the results the baseline also has.
+    """
+    key = lambda result: (result['name'], result['players'], result['rounds'])
+    base = dict((key(result), result) for result in baseline)
+    comparisons = []
+    for result in results:
+        old = base.get(key(result))
+        if old is None or not old['min']:
+            continue
+        ratio = result['min'] / old['min']
+        comparisons.append((result, ratio, ratio > 1 + tolerance))
+    return comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Times the pairing and database paths.')
+    parser.add_argument('--players', type=int, nargs='+',
+                        default=[8, 64, 512, 2048])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='memory')
+    parser.add_argument('--strategy', choices=['global', 'groups'],
+                        default='global')
+    parser.add_argument('--max-pairing', type=int, default=2048,
+                        help='largest field to time pairing stages for')
+    parser.add_argument('--output', help='file to write JSON results to, '
+                        'defaults to standard output')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown allowed before a regression')
+    args = parser.parse_args(argv)
+
+    storage = BACKENDS[args.backend]()
+    results = []
+    for players in args.players:
+        results.extend(benchmark(
+            storage, players, args.rounds, args.repeat, args.seed,
+            args.max_pairing, args.strategy))
+    report = {
+        'python': platform.python_version(),
+        'backend': args.backend,
+        'strategy': args.strategy,
+        'seed': args.seed,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        for result, ratio, regressed in compare(
+                results, baseline, args.tolerance):
+            regressions += regressed
+            sys.stderr.write('%-14s %6i players %3i rounds  %6.2fx%s\n' % (
+                result['name'], result['players'], result['rounds'], ratio,
+                '  REGRESSION' if regressed else ''))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# cache.py -- in-process caches for the Swiss-system tournament
+#
+# Caches only see writes made through tournament.py in this process, which
+# invalidates them; writes made elsewhere to the same database are missed.
+#
+
+import collections
+import threading
+from array import array
+
+from storage import Standing
+
+
+class PairingCache(object):
+    """Least-recently-used cache of swissPairings results.
+
+    Entries are keyed by (tournId, round, matchHash, options), where round and
+    matchHash describe the tournament's state when the pairings were made and
+    options are the pairing options used. Each tournament's current state is
+    remembered, so a lookup needs no database access; invalidate() forgets it
+    whenever the tournament changes.
+
+    Pairings take a while to make, and the tournament may change meanwhile.
+    Callers take a generation() before loading the round and pass it to
+    put(), which drops the pairings if the tournament was invalidated since.
+
+    Args:
+      maxEntries: the most pairings to keep.
+      maxPairs: the most pairs to keep across all pairings.
+    """
+
+    def __init__(self, maxEntries=128, maxPairs=100000):
+        self.maxEntries = maxEntries
+        self.maxPairs = maxPairs
+        self._entries = collections.OrderedDict()
+        self._states = {}
+        self._pairs = 0
+        # Bumped by invalidate(), for every tournament or for one.
+        self._epoch = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tournId, options):
+        """Returns the cached pairings for the tournament's current state and
+        options, as a new list of tuples, or None."""
+        with self._lock:
+            state = self._states.get(tournId)
+            if state is None:
+                return None
+            key = (tournId,) + state + (options,)
+            pairings = self._entries.pop(key, None)
+            if pairings is None:
+                return None
+            self._entries[key] = pairings
+        return list(pairings)
+
+    def generation(self, tournId):
+        """Returns a token that changes whenever a tournament is
+        invalidated, see put."""
+        with self._lock:
+            return (self._epoch, self._generations.get(tournId, 0))
+
+    def put(self, tournId, round_, matchHash, options, pairings,
+            generation=None):
+        """Caches pairings made for a tournament in the given state.
+
+        Args:
+          tournId: the tournament paired.
+          round_: the round the pairings are for.
+          matchHash: a hash of the tournament's matches so far.
+          options: a hashable tuple of the options the pairings depend on.
+          pairings: the list of pairs swissPairings returned.
+          generation: the tournament's generation() from before the round
+            was loaded. The pairings are dropped if it has changed since.
+        """
+        pairings = tuple(tuple(pair) for pair in pairings)
+        key = (tournId, round_, matchHash, options)
+        with self._lock:
+            if generation is not None and generation != (
+                    self._epoch, self._generations.get(tournId, 0)):
+                return
+            if self._states.get(tournId) != (round_, matchHash):
+                self._drop(tournId)
+                self._states[tournId] = (round_, matchHash)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._pairs -= len(old)
+            self._entries[key] = pairings
+            self._pairs += len(pairings)
+            while self._entries and (len(self._entries) > self.maxEntries or
+                                     self._pairs > self.maxPairs):
+                key, old = self._entries.popitem(last=False)
+                self._pairs -= len(old)
+
+    def record(self, tournId, results, generation=None):
+        """Forgets a tournament's pairings once matches are reported."""
+        self.invalidate(tournId)
+
+    def invalidate(self, tournId=None):
+        """Forgets a tournament's pairings, or every tournament's if None."""
+        with self._lock:
+            if tournId is None:
+                self._entries.clear()
+                self._states.clear()
+                self._pairs = 0
+                self._epoch += 1
+            else:
+                self._drop(tournId)
+                self._states.pop(tournId, None)
+                self._generations[tournId] = (
+                    self._generations.get(tournId, 0) + 1)
+
+    def _drop(self, tournId):
+        for key in [key for key in self._entries if key[0] == tournId]:
+            self._pairs -= len(self._entries.pop(key))
+
+
+class _TournamentStandings(object):
+    """One tournament's standings, held in arrays indexed by the players'
+    places in the standings they were loaded from."""
+
+    __slots__ = ('ids', 'names', 'index', 'wins', 'played', 'counts', 'low',
+                 'high', 'sorted')
+
+    def __init__(self, rows):
+        self.ids = array('l')
+        self.names = []
+        self.wins = array('l')
+        self.played = array('l')
+        for row in rows:
+            self.ids.append(row.id)
+            self.names.append(row.name)
+            self.wins.append(row.wins)
+            self.played.append(row.matches_played)
+        self.index = dict((id_, i) for i, id_ in enumerate(self.ids))
+        # counts[m] is the number of players who have played m matches, and
+        # low and high are the least and greatest such m.
+        self.counts = array('l', [0]) * (max(self.played or [0]) + 2)
+        for m in self.played:
+            self.counts[m] += 1
+        self.low = min(self.played or [0])
+        self.high = max(self.played or [0])
+        self.sorted = None
+
+    def record(self, winner, loser):
+        """Records a match, or a bye if loser is None, in O(1) time."""
+        w = self.index[winner]
+        self.wins[w] += 1
+        self._play(w)
+        if loser is not None:
+            self._play(self.index[loser])
+        self.sorted = None
+
+    def _play(self, i):
+        m = self.played[i]
+        self.played[i] = m + 1
+        if m + 2 > len(self.counts):
+            self.counts.append(0)
+        self.counts[m] -= 1
+        self.counts[m + 1] += 1
+        if m + 1 > self.high:
+            self.high = m + 1
+        # Match counts only grow one at a time, so the least count can only
+        # move up by one when its last player moves on.
+        if m == self.low and not self.counts[m]:
+            self.low = m + 1
+
+    def roundComplete(self):
+        return self.low == self.high
+
+    def standings(self):
+        if self.sorted is None:
+            ids, wins = self.ids, self.wins
+            order = sorted(range(len(ids)), key=lambda i: (-wins[i], ids[i]))
+            self.sorted = [
+                Standing(ids[i], self.names[i], wins[i], self.played[i])
+                for i in order]
+        return self.sorted
+
+
+class StandingsCache(object):
+    """Per-tournament standings, kept up to date as matches are reported.
+
+    A tournament's standings are loaded from storage on first use, after which
+    reported matches update them in place, so standings and roundComplete no
+    longer need the database.
+
+    Standings loaded while a match was being written may already include it.
+    Writers take a generation() before writing and pass it to record(),
+    which only updates standings loaded before then and drops the rest.
+    Standings are loaded without holding the lock, and only cached if no
+    match was recorded for the tournament meanwhile.
+    """
+
+    def __init__(self):
+        self._tournaments = {}
+        # Bumped whenever standings are loaded or dropped, for every
+        # tournament or for one.
+        self._epoch = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _bump(self, tournId):
+        self._generations[tournId] = self._generations.get(tournId, 0) + 1
+
+    def _get(self, tournId, load):
+        """Returns a tournament's _TournamentStandings, loading them with
+        load() outside the lock if they are not cached."""
+        with self._lock:
+            tourn = self._tournaments.get(tournId)
+            if tourn is not None:
+                return tourn
+            generation = (self._epoch, self._generations.get(tournId, 0))
+        tourn = _TournamentStandings(load())
+        with self._lock:
+            if generation == (self._epoch, self._generations.get(tournId, 0)):
+                self._tournaments[tournId] = tourn
+                self._bump(tournId)
+        return tourn
+
+    def generation(self, tournId):
+        """Returns a token that changes whenever a tournament's standings
+        are loaded or dropped, see record."""
+        with self._lock:
+            return (self._epoch, self._generations.get(tournId, 0))
+
+    def standings(self, tournId, load):
+        """Returns a tournament's standings as a new list of Standing rows.
+
+        Args:
+          tournId: the tournament.
+          load: a function returning the tournament's standings from
+            storage, called if they are not cached yet.
+        """
+        tourn = self._get(tournId, load)
+        with self._lock:
+            return list(tourn.standings())
+
+    def roundComplete(self, tournId, load):
+        """Returns whether every player in a tournament has played the same
+        number of matches, see standings for the arguments."""
+        tourn = self._get(tournId, load)
+        with self._lock:
+            return tourn.roundComplete()
+
+    def record(self, tournId, results, generation=None):
+        """Applies reported (winner, loser) results to cached standings.
+
+        Args:
+          tournId: the tournament the matches were reported in.
+          results: the (winner, loser) results written.
+          generation: the tournament's generation() from before the results
+            were written. Standings loaded since then, or if it is None, may
+            already count the results, so they are dropped instead.
+        """
+        with self._lock:
+            tourn = self._tournaments.get(tournId)
+            if tourn is None:
+                # Standings being loaded may or may not count the results,
+                # so keep them from being cached.
+                self._bump(tournId)
+                return
+            if generation != (self._epoch, self._generations.get(tournId, 0)):
+                del self._tournaments[tournId]
+                self._bump(tournId)
+                return
+            if any(winner not in tourn.index or
+                   (loser is not None and loser not in tourn.index)
+                   for winner, loser in results):
+                # Players entered behind our back; reload on next use.
+                del self._tournaments[tournId]
+                self._bump(tournId)
+                return
+            for winner, loser in results:
+                tourn.record(winner, loser)
+
+    def invalidate(self, tournId=None):
+        """Forgets a tournament's standings, or every tournament's if None."""
+        with self._lock:
+            if tournId is None:
+                self._tournaments.clear()
+                self._epoch += 1
+            else:
+                self._tournaments.pop(tournId, None)
+                self._bump(tournId)
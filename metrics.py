@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# metrics.py -- optional instrumentation of the tournament's hot paths
+#
+# Instrumented code reports counts and timings to the current sink, if one is
+# set with setSink. Without a sink each instrumented call costs one global
+# lookup, so instrumentation can be left in place in production.
+#
+
+import collections
+import functools
+import threading
+import timeit
+
+import mwmatching
+
+
+_sink = None
+_timer = timeit.default_timer
+
+
+def getSink():
+    """Returns the current metrics sink, or None if metrics are disabled."""
+    return _sink
+
+
+def setSink(sink):
+    """Sends metrics to a sink, or disables them if sink is None.
+
+    Args:
+      sink: an object with increment(name, value) and observe(name, seconds)
+        methods, such as a Registry.
+    """
+    global _sink
+    _sink = sink
+    mwmatching.STATS = _matchingStats if sink is not None else None
+
+
+def increment(name, value=1):
+    """Adds value to a counter, if metrics are enabled."""
+    sink = _sink
+    if sink is not None:
+        sink.increment(name, value)
+
+
+def timed(name):
+    """Decorator recording the latency of each call as the timer name."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if sink is None:
+                return fn(*args, **kwargs)
+            start = _timer()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                sink.observe(name, _timer() - start)
+        return wrapper
+    return decorate
+
+
+def _matchingStats(stats):
+    """mwmatching.STATS hook, counting the work of each matching."""
+    sink = _sink
+    if sink is not None:
+        sink.increment('matching.calls', 1)
+        for key, value in stats.items():
+            sink.increment('matching.' + key, value)
+
+
+def cursor(cur):
+    """Returns a DB-API cursor that counts its queries and rows, or cur
+    itself if metrics are disabled."""
+    sink = _sink
+    if sink is None:
+        return cur
+    return CountingCursor(cur, sink)
+
+
+class CountingCursor(object):
+    """A DB-API cursor wrapper that reports the number and latency of the
+    queries it runs, and the number of rows fetched, to a sink."""
+
+    def __init__(self, cursor, sink):
+        self._cursor = cursor
+        self._sink = sink
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._sink.increment('storage.rows', 1)
+            yield row
+
+    def _run(self, method, args):
+        self._sink.increment('storage.queries', 1)
+        start = _timer()
+        try:
+            return method(*args)
+        finally:
+            self._sink.observe('storage.query', _timer() - start)
+
+    def execute(self, *args):
+        return self._run(self._cursor.execute, args)
+
+    def executemany(self, *args):
+        return self._run(self._cursor.executemany, args)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._sink.increment('storage.rows', 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._sink.increment('storage.rows', len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._sink.increment('storage.rows', len(rows))
+        return rows
+
+
+# A timer's totals: number of calls, and total and longest seconds.
+Timing = collections.namedtuple('Timing', 'count total max')
+
+
+class Registry(object):
+    """An in-process metrics sink, holding counters and timers."""
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, longest = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = Timing(
+                count + 1, total + seconds, max(longest, seconds))
+
+    def counters(self):
+        """Returns a dict of the counters' values by name."""
+        with self._lock:
+            return dict(self._counters)
+
+    def timers(self):
+        """Returns a dict of the timers' Timings by name."""
+        with self._lock:
+            return dict(self._timers)
+
+    def reset(self):
+        """Zeroes every counter and timer."""
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def prometheusText(self, prefix='tournament_'):
+        """Returns the metrics in the Prometheus text exposition format.
+
+        Counters become counters, and each timer a summary of its count and
+        sum in seconds, plus a gauge of its longest call.
+        """
+        counters = self.counters()
+        timers = self.timers()
+        lines = []
+        for name in sorted(counters):
+            metric = prefix + name.replace('.', '_') + '_total'
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %r' % (metric, counters[name]))
+        for name in sorted(timers):
+            metric = prefix + name.replace('.', '_') + '_seconds'
+            timing = timers[name]
+            lines.append('# TYPE %s summary' % metric)
+            lines.append('%s_count %d' % (metric, timing.count))
+            lines.append('%s_sum %r' % (metric, timing.total))
+            lines.append('# TYPE %s_max gauge' % metric)
+            lines.append('%s_max %r' % (metric, timing.max))
+        return '\n'.join(lines) + '\n'
@@ -24,6 +24,23 @@ to validate this new code.
 
 from __future__ import print_function
 
+import json
+import struct
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Python 2/3 compatibility.
+from sys import version as sys_version
+if sys_version < '3':
+    integer_types = (int, long)
+else:
+    integer_types = (int,)
+
 # If assigned, DEBUG(str) is called with lots of debug messages.
 DEBUG = None
 """def DEBUG(s):
@@ -31,15 +48,125 @@ DEBUG = None
     print('DEBUG:', s, file=stderr)
 """
 
+# If assigned, STATS(dict) is called after each matching with its size and
+# work done: vertices, edges, stages, substages, augmentations, blossoms
+# (created) and expansions.
+STATS = None
+
+# If assigned a MatchingTracer, the events of each matching are recorded in it.
+TRACE = None
+
 # Check delta2/delta3 computation after every substage;
 # only works on integer weights, slows down the algorithm to O(n^4).
 CHECK_DELTA = False
 
 # Check optimality of solution before returning; only works on integer weights.
-CHECK_OPTIMUM = True
-
-
-def maxWeightMatching(edges, maxcardinality=False):
+# Default for the "checkoptimum" argument of maxWeightMatching().
+CHECK_OPTIMUM = False
+
+
+# Optimal dual solution returned by maxWeightMatching(returndual=True).
+# vertex[v] is 2 * u(v), the dual variable of vertex v (as dualvar below).
+# Non-trivial blossoms are numbered 0 .. (len(blossom)-1);
+# blossom[b] is z(b), the dual variable of blossom b;
+# blossomparent[b] is the blossom immediately containing b, or -1;
+# vertexblossom[v] is the innermost blossom containing vertex v, or -1.
+MatchingDual = namedtuple('MatchingDual',
+                          'vertex blossom blossomparent vertexblossom')
+
+
+class MatchingTracer(object):
+    """Records the events of maxWeightMatching() in a preallocated ring
+    buffer, keeping the most recent capacity events.
+
+    Unlike DEBUG, recording formats nothing, so tracing a slow matching
+    barely changes its timing. Assign an instance to TRACE to enable it;
+    a tracer should only see one matching at a time.
+
+    Each event has a type and three integer arguments a, b, c, plus a
+    value for delta events:
+      start          a = vertices, b = edge slots, c = maxcardinality
+      stage          a = stage number
+      assignLabel    a = vertex w, b = label t, c = endpoint p
+      addBlossom     a = base, b = edge k, c = new blossom
+      expandBlossom  a = blossom, b = endstage
+      augment        a = edge k, b, c = its vertices
+      delta          a = delta type, b = edge, c = blossom (-1 if none),
+                     value = delta
+    """
+
+    EVENTS = ('start', 'stage', 'assignLabel', 'addBlossom',
+              'expandBlossom', 'augment', 'delta')
+    (START, STAGE, ASSIGN_LABEL, ADD_BLOSSOM, EXPAND_BLOSSOM, AUGMENT,
+     DELTA) = range(len(EVENTS))
+
+    # Binary dumps are a header of magic, version, first sequence number
+    # and event count, then one fixed-size record per event.
+    _HEADER = struct.Struct('<4sHQQ')
+    _RECORD = struct.Struct('<Bqqqd')
+    _MAGIC = b'MWTR'
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.count = 0
+        self._types = bytearray(capacity)
+        self._args = array('l', [ 0 ]) * (3 * capacity)
+        self._values = array('d', [ 0.0 ]) * capacity
+
+    def record(self, event, a=0, b=0, c=0, value=0.0):
+        """Records an event, overwriting the oldest if the buffer is full."""
+        i = self.count % self.capacity
+        self._types[i] = event
+        self._args[3*i] = a
+        self._args[3*i+1] = b
+        self._args[3*i+2] = c
+        self._values[i] = value
+        self.count += 1
+
+    def clear(self):
+        """Forgets every recorded event."""
+        self.count = 0
+
+    def events(self):
+        """Yields the buffered events, oldest first, as tuples
+        (sequence number, event name, a, b, c, value)."""
+        first = max(0, self.count - self.capacity)
+        for seq in range(first, self.count):
+            i = seq % self.capacity
+            yield (seq, self.EVENTS[self._types[i]], self._args[3*i],
+                   self._args[3*i+1], self._args[3*i+2], self._values[i])
+
+    def dumpJson(self, f):
+        """Writes the buffered events to text file f as JSON lines."""
+        for (seq, event, a, b, c, value) in self.events():
+            f.write(json.dumps({ 'seq': seq, 'event': event,
+                                 'args': [ a, b, c ], 'value': value }))
+            f.write('\n')
+
+    def dumpBinary(self, f):
+        """Writes the buffered events to binary file f, see readBinary."""
+        first = max(0, self.count - self.capacity)
+        f.write(self._HEADER.pack(self._MAGIC, 1, first, self.count - first))
+        for (seq, event, a, b, c, value) in self.events():
+            f.write(self._RECORD.pack(self.EVENTS.index(event), a, b, c,
+                                      value))
+
+    @classmethod
+    def readBinary(cls, f):
+        """Yields the events written by dumpBinary to binary file f, as
+        events() does."""
+        magic, version, first, n = cls._HEADER.unpack(
+            f.read(cls._HEADER.size))
+        if magic != cls._MAGIC or version != 1:
+            raise ValueError('Not a matching trace')
+        for seq in range(first, first + n):
+            (event, a, b, c, value) = cls._RECORD.unpack(
+                f.read(cls._RECORD.size))
+            yield (seq, cls.EVENTS[event], a, b, c, value)
+
+
+def maxWeightMatching(edges, maxcardinality=False, returndual=False,
+                      checkoptimum=None):
     """Compute a maximum-weighted matching in the general undirected
     weighted graph given by "edges".  If "maxcardinality" is true,
     only maximum-cardinality matchings are considered as solutions.
@@ -51,30 +178,19 @@ def maxWeightMatching(edges, maxcardinality=False):
 
     Return a list "mate", such that mate[i] == j if vertex i is
     matched to vertex j, and mate[i] == -1 if vertex i is not matched.
+    If "returndual" is true, return a tuple (mate, dual) where dual is
+    the MatchingDual that certifies the matching is optimal.
 
-    This function takes time O(n ** 3)."""
+    If "checkoptimum" is true, verify the solution is optimal before
+    returning (integer weights only); it defaults to CHECK_OPTIMUM.
+    See checkMatching() for a cheaper check to run on a sample of calls.
 
-    #
-    # Vertices are numbered 0 .. (nvertex-1).
-    # Non-trivial blossoms are numbered nvertex .. (2*nvertex-1)
-    #
-    # Edges are numbered 0 .. (nedge-1).
-    # Edge endpoints are numbered 0 .. (2*nedge-1), such that endpoints
-    # (2*k) and (2*k+1) both belong to edge k.
-    #
-    # Many terms used in the comments (sub-blossom, T-vertex) come from
-    # the paper by Galil; read the paper before reading this code.
-    #
-
-    # Python 2/3 compatibility.
-    from sys import version as sys_version
-    if sys_version < '3':
-        integer_types = (int, long)
-    else:
-        integer_types = (int,)
+    This function takes time O(n ** 3)."""
 
     # Deal swiftly with empty graphs.
     if not edges:
+        if returndual:
+            return [ ], MatchingDual([ ], [ ], [ ], [ ])
         return [ ]
 
     # Count vertices.
@@ -90,25 +206,214 @@ def maxWeightMatching(edges, maxcardinality=False):
     # Find the maximum edge weight.
     maxweight = max(0, max([ wt for (i, j, wt) in edges ]))
 
+    endpoint = array('l', [ edges[p//2][p%2] for p in range(2*nedge) ])
+    twoweight = [ 2 * wt for (i, j, wt) in edges ]
+    neighbend = [ [ ] for i in range(nvertex) ]
+    for k in range(len(edges)):
+        (i, j, w) = edges[k]
+        neighbend[i].append(2*k+1)
+        neighbend[j].append(2*k)
+
+    def edgeof(v, w):
+        if not edgeindex:
+            edgeindex.update(((i, j), k)
+                             for (k, (i, j, wt)) in enumerate(edges))
+        return edgeindex.get((v, w), edgeindex.get((w, v)))
+    edgeindex = { }
+
+    integral = all([ isinstance(wt, integer_types) for (i, j, wt) in edges ])
+    graph = _Graph(nvertex, nedge, endpoint, twoweight, neighbend,
+                   range(nedge), edgeof, maxweight, integral)
+    return _matchGraph(graph, maxcardinality, returndual, checkoptimum)
+
+
+def maxWeightMatchingDense(weights, forbidden=None, maxcardinality=False,
+                           returndual=False, checkoptimum=None):
+    """Compute a maximum-weighted matching like maxWeightMatching(), in
+    the complete graph on n vertices with edge weights given by the n x n
+    matrix "weights": the edge between vertices i < j has weight
+    weights[i][j].  If "forbidden" is given, it is an n x n matrix of
+    booleans, and there is no edge between vertices i < j for which
+    forbidden[i][j] is true.  Only the upper triangles are read.  Both may
+    be lists of lists or 2-d NumPy arrays.
+
+    Return a list "mate" of length n, and a dual if "returndual" is true,
+    as maxWeightMatching() does; "checkoptimum" is as for
+    maxWeightMatching() too.
+
+    Edges are numbered implicitly rather than stored: besides O(n) state,
+    this needs the upper triangle of the weights (8 bytes each) and of
+    the forbidden mask (1 byte each), and two flags per vertex pair, so
+    about 6.5 * n ** 2 bytes, e.g. 160 MB for 5000 vertices.
+
+    This function takes time O(n ** 3)."""
+
+    n = len(weights)
+    # rows[i][j-i-1] is the weight of the edge between i < j, and
+    # allowed[i][j-i-1] is true if there is such an edge.
+    rows = [ ]
+    allowed = [ ]
+    maxweight = 0
+    integral = True
+    for i in range(n):
+        try:
+            row = array('l', weights[i][i+1:])
+        except TypeError:
+            row = array('d', weights[i][i+1:])
+            integral = False
+        rows.append(row)
+        if forbidden is None:
+            ok = bytearray(b'\x01') * (n - i - 1)
+        else:
+            ok = bytearray([ not f for f in forbidden[i][i+1:] ])
+        allowed.append(ok)
+        if all(ok):
+            maxweight = max([ maxweight ] + list(row))
+        else:
+            maxweight = max([ maxweight ] +
+                            [ w for (w, e) in zip(row, ok) if e ])
+    if integral:
+        maxweight = int(maxweight)
+
+    # Deal swiftly with graphs without edges.
+    if not [ ok for ok in allowed if any(ok) ]:
+        if returndual:
+            return n * [ -1 ], MatchingDual(n * [ 0 ], [ ], [ ], n * [ -1 ])
+        return n * [ -1 ]
+
+    def edgeof(v, w):
+        (i, j) = (min(v, w), max(v, w))
+        if i != j and allowed[i][j-i-1]:
+            return i * n + j
+        return None
+
+    graph = _Graph(n, n * n, _DenseEndpoints(n), _DenseTwoWeights(n, rows),
+                   _DenseNeighbours(n, allowed), _DenseEdgeIds(n, allowed),
+                   edgeof, maxweight, integral)
+    return _matchGraph(graph, maxcardinality, returndual, checkoptimum)
+
+
+# In maxWeightMatchingDense(), the edge between vertices i < j is numbered
+# k = i * n + j; the classes below give the algorithm the same view of such
+# a graph as of the lists built by maxWeightMatching().
+
+class _DenseEndpoints(object):
+    """endpoint[p] of a dense graph."""
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+    def __getitem__(self, p):
+        if p & 1:
+            return (p >> 1) % self.n
+        return (p >> 1) // self.n
+
+
+class _DenseTwoWeights(object):
+    """twoweight[k] of a dense graph."""
+    __slots__ = ('n', 'rows')
+
+    def __init__(self, n, rows):
+        self.n = n
+        self.rows = rows
+
+    def __getitem__(self, k):
+        (i, j) = divmod(k, self.n)
+        return 2 * self.rows[i][j-i-1]
+
+
+class _DenseNeighbours(object):
+    """neighbend[v] of a dense graph, computed when asked for."""
+    __slots__ = ('n', 'allowed')
+
+    def __init__(self, n, allowed):
+        self.n = n
+        self.allowed = allowed
+
+    def __getitem__(self, v):
+        (n, allowed) = (self.n, self.allowed)
+        ends = [ 2 * (u*n + v) for u in range(v) if allowed[u][v-u-1] ]
+        row = allowed[v]
+        ends.extend([ 2 * (v*n + v+1 + d) + 1
+                      for d in range(len(row)) if row[d] ])
+        return ends
+
+
+class _DenseEdgeIds(object):
+    """The numbers of the edges of a dense graph, in order."""
+    __slots__ = ('n', 'allowed')
+
+    def __init__(self, n, allowed):
+        self.n = n
+        self.allowed = allowed
+
+    def __len__(self):
+        return sum(len(row) - row.count(b'\0') for row in self.allowed)
+
+    def __iter__(self):
+        n = self.n
+        for (i, row) in enumerate(self.allowed):
+            for d in range(len(row)):
+                if row[d]:
+                    yield i * n + i+1 + d
+
+
+# A graph as seen by the matching algorithm, see _matchGraph().
+_Graph = namedtuple('_Graph', 'nvertex nedge endpoint twoweight neighbend '
+                              'edgeids edgeof maxweight integral')
+
+
+def _matchGraph(graph, maxcardinality, returndual, checkoptimum):
+    """The matching algorithm behind maxWeightMatching() and
+    maxWeightMatchingDense(), on a non-empty _Graph."""
+
+    #
+    # Vertices are numbered 0 .. (nvertex-1).
+    # Non-trivial blossoms are numbered nvertex .. (2*nvertex-1)
+    #
+    # Edges are numbered 0 .. (nedge-1), though only the numbers in
+    # graph.edgeids need be in use.
+    # Edge endpoints are numbered 0 .. (2*nedge-1), such that endpoints
+    # (2*k) and (2*k+1) both belong to edge k.
+    #
+    # Many terms used in the comments (sub-blossom, T-vertex) come from
+    # the paper by Galil; read the paper before reading this code.
+    #
+
+    nvertex = graph.nvertex
+    nedge = graph.nedge
+    maxweight = graph.maxweight
+
+    trace = TRACE
+    if trace is not None:
+        trace.record(MatchingTracer.START, nvertex, nedge,
+                     int(bool(maxcardinality)))
+
     # If p is an edge endpoint,
     # endpoint[p] is the vertex to which endpoint p is attached.
     # Not modified by the algorithm.
-    endpoint = [ edges[p//2][p%2] for p in range(2*nedge) ]
+    endpoint = graph.endpoint
+
+    # If k is an edge, twoweight[k] is twice its weight.
+    # Not modified by the algorithm.
+    twoweight = graph.twoweight
 
     # If v is a vertex,
     # neighbend[v] is the list of remote endpoints of the edges attached to v.
     # Not modified by the algorithm.
-    neighbend = [ [ ] for i in range(nvertex) ]
-    for k in range(len(edges)):
-        (i, j, w) = edges[k]
-        neighbend[i].append(2*k+1)
-        neighbend[j].append(2*k)
+    neighbend = graph.neighbend
+
+    # Templates to reset the per-stage arrays below without allocating.
+    zeros = array('l', [ 0 ]) * (2 * nvertex)
+    minusones = array('l', [ -1 ]) * (2 * nvertex)
+    noedges = bytearray(nedge)
 
     # If v is a vertex,
     # mate[v] is the remote endpoint of its matched edge, or -1 if it is single
     # (i.e. endpoint[mate[v]] is v's partner vertex).
     # Initially all vertices are single; updated during augmentation.
-    mate = nvertex * [ -1 ]
+    mate = array('l', [ -1 ]) * nvertex
 
     # If b is a top-level blossom,
     # label[b] is 0 if b is unlabeled (free);
@@ -119,7 +424,7 @@ def maxWeightMatching(edges, maxcardinality=False):
     # If v is a vertex inside a T-blossom,
     # label[v] is 2 iff v is reachable from an S-vertex outside the blossom.
     # Labels are assigned during a stage and reset after each augmentation.
-    label = (2 * nvertex) * [ 0 ]
+    label = array('l', zeros)
 
     # If b is a labeled top-level blossom,
     # labelend[b] is the remote endpoint of the edge through which b obtained
@@ -127,19 +432,19 @@ def maxWeightMatching(edges, maxcardinality=False):
     # If v is a vertex inside a T-blossom and label[v] == 2,
     # labelend[v] is the remote endpoint of the edge through which v is
     # reachable from outside the blossom.
-    labelend = (2 * nvertex) * [ -1 ]
+    labelend = array('l', minusones)
 
     # If v is a vertex,
     # inblossom[v] is the top-level blossom to which v belongs.
     # If v is a top-level vertex, v is itself a blossom (a trivial blossom)
     # and inblossom[v] == v.
     # Initially all vertices are top-level trivial blossoms.
-    inblossom = list(range(nvertex))
+    inblossom = array('l', range(nvertex))
 
     # If b is a sub-blossom,
     # blossomparent[b] is its immediate parent (sub-)blossom.
     # If b is a top-level blossom, blossomparent[b] is -1.
-    blossomparent = (2 * nvertex) * [ -1 ]
+    blossomparent = array('l', minusones)
 
     # If b is a non-trivial (sub-)blossom,
     # blossomchilds[b] is an ordered list of its sub-blossoms, starting with
@@ -148,7 +453,7 @@ def maxWeightMatching(edges, maxcardinality=False):
 
     # If b is a (sub-)blossom,
     # blossombase[b] is its base VERTEX (i.e. recursive sub-blossom).
-    blossombase = list(range(nvertex)) + nvertex * [ -1 ]
+    blossombase = array('l', range(nvertex)) + array('l', [ -1 ]) * nvertex
 
     # If b is a non-trivial (sub-)blossom,
     # blossomendps[b] is a list of endpoints on its connecting edges,
@@ -163,7 +468,7 @@ def maxWeightMatching(edges, maxcardinality=False):
     # bestedge[b] is the least-slack edge to a different S-blossom,
     # or -1 if there is no such edge.
     # This is used for efficient computation of delta2 and delta3.
-    bestedge = (2 * nvertex) * [ -1 ]
+    bestedge = array('l', minusones)
 
     # If b is a non-trivial top-level S-blossom,
     # blossombestedges[b] is a list of least-slack edges to neighbouring
@@ -186,49 +491,63 @@ def maxWeightMatching(edges, maxcardinality=False):
     # If allowedge[k] is true, edge k has zero slack in the optimization
     # problem; if allowedge[k] is false, the edge's slack may or may not
     # be zero.
-    allowedge = nedge * [ False ]
+    allowedge = bytearray(nedge)
+
+    # Scratch space for addBlossom(): bestedgeto[b] is the least-slack edge
+    # from the new blossom to S-blossom b. Reset to -1 after each use.
+    bestedgeto = array('l', minusones)
 
     # Queue of newly discovered S-vertices.
     queue = [ ]
 
+    # Counts of substages, augmentations, blossoms created and blossoms
+    # expanded, for STATS.
+    counts = [ 0, 0, 0, 0 ]
+
     # Return 2 * slack of edge k (does not work inside blossoms).
     def slack(k):
-        (i, j, wt) = edges[k]
-        return dualvar[i] + dualvar[j] - 2 * wt
+        return (dualvar[endpoint[2*k]] + dualvar[endpoint[2*k+1]] -
+                twoweight[k])
 
-    # Generate the leaf vertices of a blossom.
+    # Return the list of leaf vertices of a blossom, in order.
     def blossomLeaves(b):
         if b < nvertex:
-            yield b
-        else:
-            for t in blossomchilds[b]:
-                if t < nvertex:
-                    yield t
-                else:
-                    for v in blossomLeaves(t):
-                        yield v
+            return [ b ]
+        leaves = [ ]
+        stack = [ b ]
+        while stack:
+            t = stack.pop()
+            if t < nvertex:
+                leaves.append(t)
+            else:
+                stack.extend(reversed(blossomchilds[t]))
+        return leaves
 
     # Assign label t to the top-level blossom containing vertex w
     # and record the fact that w was reached through the edge with
     # remote endpoint p.
     def assignLabel(w, t, p):
-        if DEBUG: DEBUG('assignLabel(%d,%d,%d)' % (w, t, p))
-        b = inblossom[w]
-        assert label[w] == 0 and label[b] == 0
-        label[w] = label[b] = t
-        labelend[w] = labelend[b] = p
-        bestedge[w] = bestedge[b] = -1
-        if t == 1:
-            # b became an S-vertex/blossom; add it(s vertices) to the queue.
-            queue.extend(blossomLeaves(b))
-            if DEBUG: DEBUG('PUSH ' + str(list(blossomLeaves(b))))
-        elif t == 2:
+        while 1:
+            if DEBUG: DEBUG('assignLabel(%d,%d,%d)' % (w, t, p))
+            if trace is not None:
+                trace.record(MatchingTracer.ASSIGN_LABEL, w, t, p)
+            b = inblossom[w]
+            assert label[w] == 0 and label[b] == 0
+            label[w] = label[b] = t
+            labelend[w] = labelend[b] = p
+            bestedge[w] = bestedge[b] = -1
+            if t == 1:
+                # b became an S-vertex/blossom; add it(s vertices) to the
+                # queue.
+                queue.extend(blossomLeaves(b))
+                if DEBUG: DEBUG('PUSH ' + str(blossomLeaves(b)))
+                return
             # b became a T-vertex/blossom; assign label S to its mate.
             # (If b is a non-trivial blossom, its base is the only vertex
             # with an external mate.)
             base = blossombase[b]
             assert mate[base] >= 0
-            assignLabel(endpoint[mate[base]], 1, mate[base] ^ 1)
+            (w, t, p) = (endpoint[mate[base]], 1, mate[base] ^ 1)
 
     # Trace back from vertices v and w to discover either a new blossom
     # or an augmenting path. Return the base vertex of the new blossom or -1.
@@ -271,13 +590,16 @@ def maxWeightMatching(edges, maxcardinality=False):
     # connects a pair of S vertices. Label the new blossom as S; set its dual
     # variable to zero; relabel its T-vertices to S and add them to the queue.
     def addBlossom(base, k):
-        (v, w, wt) = edges[k]
+        (v, w) = (endpoint[2*k], endpoint[2*k+1])
         bb = inblossom[base]
         bv = inblossom[v]
         bw = inblossom[w]
         # Create blossom.
         b = unusedblossoms.pop()
         if DEBUG: DEBUG('addBlossom(%d,%d) (v=%d w=%d) -> %d' % (base, k, v, w, b))
+        counts[2] += 1
+        if trace is not None:
+            trace.record(MatchingTracer.ADD_BLOSSOM, base, k, b)
         blossombase[b] = base
         blossomparent[b] = -1
         blossomparent[bb] = b
@@ -327,7 +649,7 @@ def maxWeightMatching(edges, maxcardinality=False):
                 queue.append(v)
             inblossom[v] = b
         # Compute blossombestedges[b].
-        bestedgeto = (2 * nvertex) * [ -1 ]
+        touched = [ ]
         for bv in path:
             if blossombestedges[bv] is None:
                 # This subblossom does not have a list of least-slack edges;
@@ -339,18 +661,23 @@ def maxWeightMatching(edges, maxcardinality=False):
                 nblists = [ blossombestedges[bv] ]
             for nblist in nblists:
                 for k in nblist:
-                    (i, j, wt) = edges[k]
+                    (i, j) = (endpoint[2*k], endpoint[2*k+1])
                     if inblossom[j] == b:
                         i, j = j, i
                     bj = inblossom[j]
-                    if (bj != b and label[bj] == 1 and
-                        (bestedgeto[bj] == -1 or
-                         slack(k) < slack(bestedgeto[bj]))):
-                        bestedgeto[bj] = k
+                    if bj != b and label[bj] == 1:
+                        if bestedgeto[bj] == -1:
+                            touched.append(bj)
+                            bestedgeto[bj] = k
+                        elif slack(k) < slack(bestedgeto[bj]):
+                            bestedgeto[bj] = k
             # Forget about least-slack edges of the subblossom.
             blossombestedges[bv] = None
             bestedge[bv] = -1
-        blossombestedges[b] = [ k for k in bestedgeto if k != -1 ]
+        touched.sort()
+        blossombestedges[b] = [ bestedgeto[bj] for bj in touched ]
+        for bj in touched:
+            bestedgeto[bj] = -1
         # Select bestedge[b].
         bestedge[b] = -1
         for k in blossombestedges[b]:
@@ -361,6 +688,9 @@ def maxWeightMatching(edges, maxcardinality=False):
     # Expand the given top-level blossom.
     def expandBlossom(b, endstage):
         if DEBUG: DEBUG('expandBlossom(%d,%d) %s' % (b, endstage, repr(blossomchilds[b])))
+        counts[3] += 1
+        if trace is not None:
+            trace.record(MatchingTracer.EXPAND_BLOSSOM, b, int(endstage))
         # Convert sub-blossoms into top-level blossoms.
         for s in blossomchilds[b]:
             blossomparent[s] = -1
@@ -495,8 +825,11 @@ def maxWeightMatching(edges, maxcardinality=False):
     # single vertices. The augmenting path runs through edge k, which
     # connects a pair of S vertices.
     def augmentMatching(k):
-        (v, w, wt) = edges[k]
+        (v, w) = (endpoint[2*k], endpoint[2*k+1])
         if DEBUG: DEBUG('augmentMatching(%d) (v=%d w=%d)' % (k, v, w))
+        counts[1] += 1
+        if trace is not None:
+            trace.record(MatchingTracer.AUGMENT, k, v, w)
         if DEBUG: DEBUG('PAIR %d %d (k=%d)' % (v, w, k))
         for (s, p) in ((v, 2*k+1), (w, 2*k)):
             # Match vertex s to remote endpoint p. Then trace back from s
@@ -546,9 +879,9 @@ def maxWeightMatching(edges, maxcardinality=False):
         assert min(dualvar[nvertex:]) >= 0
         # 0. all edges have non-negative slack and
         # 1. all matched edges have zero slack;
-        for k in range(nedge):
-            (i, j, wt) = edges[k]
-            s = dualvar[i] + dualvar[j] - 2 * wt
+        for k in graph.edgeids:
+            (i, j) = (endpoint[2*k], endpoint[2*k+1])
+            s = dualvar[i] + dualvar[j] - twoweight[k]
             iblossoms = [ i ]
             jblossoms = [ j ]
             while blossomparent[iblossoms[-1]] != -1:
@@ -613,7 +946,8 @@ def maxWeightMatching(edges, maxcardinality=False):
                                 bk = k
                                 bd = d
                 if bestedge[b] != -1:
-                    (i, j, wt) = edges[bestedge[b]]
+                    (i, j) = (endpoint[2*bestedge[b]],
+                              endpoint[2*bestedge[b]+1])
                     assert inblossom[i] == b or inblossom[j] == b
                     assert inblossom[i] != b or inblossom[j] != b
                     assert label[inblossom[i]] == 1 and label[inblossom[j]] == 1
@@ -625,23 +959,27 @@ def maxWeightMatching(edges, maxcardinality=False):
         assert bd == tbd
 
     # Main loop: continue until no further improvement is possible.
+    stages = 0
     for t in range(nvertex):
+        stages += 1
 
         # Each iteration of this loop is a "stage".
         # A stage finds an augmenting path and uses that to improve
         # the matching.
         if DEBUG: DEBUG('STAGE %d' % t)
+        if trace is not None:
+            trace.record(MatchingTracer.STAGE, t)
 
         # Remove labels from top-level blossoms/vertices.
-        label[:] = (2 * nvertex) * [ 0 ]
+        label[:] = zeros
 
         # Forget all about least-slack edges.
-        bestedge[:] = (2 * nvertex) * [ -1 ]
+        bestedge[:] = minusones
         blossombestedges[nvertex:] = nvertex * [ None ]
 
         # Loss of labeling means that we can not be sure that currently
         # allowable edges remain allowable througout this stage.
-        allowedge[:] = nedge * [ False ]
+        allowedge[:] = noedges
 
         # Make queue empty.
         queue[:] = [ ]
@@ -662,6 +1000,7 @@ def maxWeightMatching(edges, maxcardinality=False):
             # primal-dual method is used to pump some slack out of
             # the dual variables.
             if DEBUG: DEBUG('SUBSTAGE')
+            counts[0] += 1
 
             # Continue labeling until all vertices which are reachable
             # through an alternating path have got a label.
@@ -681,7 +1020,7 @@ def maxWeightMatching(edges, maxcardinality=False):
                         # this edge is internal to a blossom; ignore it
                         continue
                     if not allowedge[k]:
-                        kslack = slack(k)
+                        kslack = dualvar[v] + dualvar[w] - twoweight[k]
                         if kslack <= 0:
                             # edge k has zero slack => it is allowable
                             allowedge[k] = True
@@ -808,13 +1147,18 @@ def maxWeightMatching(edges, maxcardinality=False):
 
             # Take action at the point where minimum delta occurred.
             if DEBUG: DEBUG('delta%d=%f' % (deltatype, delta))
+            if trace is not None:
+                trace.record(MatchingTracer.DELTA, deltatype,
+                             -1 if deltaedge is None else deltaedge,
+                             -1 if deltablossom is None else deltablossom,
+                             delta)
             if deltatype == 1: 
                 # No further improvement possible; optimum reached.
                 break
             elif deltatype == 2:
                 # Use the least-slack edge to continue the search.
                 allowedge[deltaedge] = True
-                (i, j, wt) = edges[deltaedge]
+                (i, j) = (endpoint[2*deltaedge], endpoint[2*deltaedge+1])
                 if label[inblossom[i]] == 0:
                     i, j = j, i
                 assert label[inblossom[i]] == 1
@@ -822,7 +1166,7 @@ def maxWeightMatching(edges, maxcardinality=False):
             elif deltatype == 3:
                 # Use the least-slack edge to continue the search.
                 allowedge[deltaedge] = True
-                (i, j, wt) = edges[deltaedge]
+                (i, j) = (endpoint[2*deltaedge], endpoint[2*deltaedge+1])
                 assert label[inblossom[i]] == 1
                 queue.append(i)
             elif deltatype == 4:
@@ -841,20 +1185,207 @@ def maxWeightMatching(edges, maxcardinality=False):
                  label[b] == 1 and dualvar[b] == 0 ):
                 expandBlossom(b, True)
 
+    if STATS:
+        STATS({ 'vertices': nvertex, 'edges': len(graph.edgeids),
+                'stages': stages, 'substages': counts[0],
+                'augmentations': counts[1], 'blossoms': counts[2],
+                'expansions': counts[3] })
+
     # Verify that we reached the optimum solution.
-    if CHECK_OPTIMUM:
+    if checkoptimum is None:
+        checkoptimum = CHECK_OPTIMUM
+    if checkoptimum:
         verifyOptimum()
 
-    # Transform mate[] such that mate[v] is the vertex to which v is paired.
-    for v in range(nvertex):
-        if mate[v] >= 0:
-            mate[v] = endpoint[mate[v]]
+    # Transform mate[] into a list such that mate[v] is the vertex to which
+    # v is paired.
+    mate = [ endpoint[p] if p >= 0 else -1 for p in mate ]
     for v in range(nvertex):
         assert mate[v] == -1 or mate[mate[v]] == v
 
+    if returndual:
+        # Renumber the remaining non-trivial blossoms from 0.
+        blossoms = [ b for b in range(nvertex, 2*nvertex)
+                     if blossombase[b] >= 0 ]
+        blossomid = dict((b, k) for (k, b) in enumerate(blossoms))
+        dual = MatchingDual(
+            dualvar[:nvertex],
+            [ dualvar[b] for b in blossoms ],
+            [ blossomid.get(blossomparent[b], -1) for b in blossoms ],
+            [ blossomid.get(blossomparent[v], -1) for v in range(nvertex) ])
+        return mate, dual
+
     return mate
 
 
+def edgeSlack(dual, i, j, wt):
+    """Return 2 * the slack of edge (i, j, wt) under the dual solution
+    "dual" returned by maxWeightMatching.  Edges with negative slack
+    violate the dual, so a matching certified by it need not be optimal
+    in a graph that also contains them."""
+
+    # Blossoms containing i, innermost first.
+    iblossoms = set()
+    b = dual.vertexblossom[i]
+    while b != -1:
+        iblossoms.add(b)
+        b = dual.blossomparent[b]
+    s = dual.vertex[i] + dual.vertex[j] - 2 * wt
+    b = dual.vertexblossom[j]
+    while b != -1:
+        if b in iblossoms:
+            s += 2 * dual.blossom[b]
+        b = dual.blossomparent[b]
+    return s
+
+
+def checkMatching(edges, mate, dual, maxcardinality=False, tolerance=0):
+    """Check that "mate" is a matching of the graph given by "edges" and
+    that "dual" (a MatchingDual as returned by maxWeightMatching with
+    "returndual") proves it optimal.  Return True if so, False otherwise.
+
+    This checks the same conditions as maxWeightMatching's own
+    verification, using NumPy when it is installed.  Slacks and duals
+    are compared within "tolerance", which must be positive to check
+    floating point weights.
+
+    This function takes time O(m * d) for m edges and blossoms nested
+    d deep."""
+
+    if not edges:
+        return not mate
+    nvertex = len(mate)
+    nblossom = len(dual.blossom)
+    if len(dual.vertex) != nvertex or len(dual.vertexblossom) != nvertex:
+        return False
+    if max([ max(i, j) for (i, j, wt) in edges ]) >= nvertex:
+        return False
+
+    # anc[v] lists the blossoms containing vertex v, outermost first.
+    anc = [ ]
+    for v in range(nvertex):
+        chain = [ ]
+        b = dual.vertexblossom[v]
+        while b != -1:
+            chain.append(b)
+            b = dual.blossomparent[b]
+        chain.reverse()
+        anc.append(chain)
+    depth = max([ len(chain) for chain in anc ])
+
+    if numpy is not None:
+        return _checkMatchingNumpy(edges, mate, dual, maxcardinality,
+                                   tolerance, anc, depth)
+
+    # All pairs are mutual and all vertex and blossom duals feasible.
+    if [ v for v in range(nvertex)
+         if mate[v] != -1 and not (0 <= mate[v] < nvertex and
+                                   mate[mate[v]] == v) ]:
+        return False
+    vdualoffset = 0
+    if maxcardinality:
+        vdualoffset = max(0, -min(dual.vertex))
+    if min(dual.vertex) + vdualoffset < -tolerance:
+        return False
+    if dual.blossom and min(dual.blossom) < -tolerance:
+        return False
+
+    # Every edge has non-negative slack, and matched edges zero slack.
+    # Count the matched edges inside each blossom on the way.
+    inside = nblossom * [ 0 ]
+    nmatched = 0
+    for (i, j, wt) in edges:
+        s = dual.vertex[i] + dual.vertex[j] - 2 * wt
+        for (bi, bj) in zip(anc[i], anc[j]):
+            if bi != bj:
+                break
+            s += 2 * dual.blossom[bi]
+            if mate[i] == j:
+                inside[bi] += 1
+        if s < -tolerance:
+            return False
+        if mate[i] == j:
+            nmatched += 1
+            if abs(s) > tolerance:
+                return False
+    if 2 * nmatched != nvertex - list(mate).count(-1):
+        return False
+
+    # Single vertices have zero dual (up to the offset).
+    for v in range(nvertex):
+        if mate[v] == -1 and abs(dual.vertex[v] + vdualoffset) > tolerance:
+            return False
+
+    # Blossoms with positive dual are full.
+    size = nblossom * [ 0 ]
+    for chain in anc:
+        for b in chain:
+            size[b] += 1
+    for b in range(nblossom):
+        if dual.blossom[b] > tolerance and 2 * inside[b] + 1 != size[b]:
+            return False
+    return True
+
+
+def _checkMatchingNumpy(edges, mate, dual, maxcardinality, tolerance,
+                        anc, depth):
+    """checkMatching, with the per-edge conditions checked as arrays."""
+
+    nvertex = len(mate)
+    nblossom = len(dual.blossom)
+    mate = numpy.asarray(mate, dtype=numpy.int64)
+    vdual = numpy.asarray(dual.vertex)
+    bdual = numpy.asarray(dual.blossom, dtype=vdual.dtype)
+    (ei, ej, wt) = [ numpy.asarray(column) for column in zip(*edges) ]
+    ei = ei.astype(numpy.int64)
+    ej = ej.astype(numpy.int64)
+
+    # All pairs are mutual and all vertex and blossom duals feasible.
+    paired = mate != -1
+    if ((mate[paired] < 0) | (mate[paired] >= nvertex)).any():
+        return False
+    if (mate[mate[paired]] != numpy.flatnonzero(paired)).any():
+        return False
+    vdualoffset = 0
+    if maxcardinality:
+        vdualoffset = max(0, -vdual.min())
+    if vdual.min() + vdualoffset < -tolerance:
+        return False
+    if nblossom and bdual.min() < -tolerance:
+        return False
+
+    # Every edge has non-negative slack, and matched edges zero slack.
+    s = vdual[ei] + vdual[ej] - 2 * wt
+    matched = mate[ei] == ej
+    inside = numpy.zeros(nblossom, dtype=numpy.int64)
+    size = numpy.zeros(nblossom, dtype=numpy.int64)
+    if depth:
+        # ancestors[v, d] is the blossom containing v at nesting depth d.
+        ancestors = numpy.full((nvertex, depth), -1, dtype=numpy.int64)
+        for (v, chain) in enumerate(anc):
+            ancestors[v, :len(chain)] = chain
+        common = numpy.logical_and.accumulate(
+            (ancestors[ei] == ancestors[ej]) & (ancestors[ei] != -1), axis=1)
+        shared = numpy.where(common, ancestors[ei], 0)
+        s = s + 2 * (bdual[shared] * common).sum(axis=1)
+        inside = numpy.bincount(shared[matched][common[matched]],
+                                minlength=nblossom)
+        size = numpy.bincount(ancestors[ancestors != -1], minlength=nblossom)
+    if (s < -tolerance).any() or (abs(s[matched]) > tolerance).any():
+        return False
+    if 2 * matched.sum() != paired.sum():
+        return False
+
+    # Single vertices have zero dual (up to the offset).
+    if (abs(vdual[~paired] + vdualoffset) > tolerance).any():
+        return False
+
+    # Blossoms with positive dual are full.
+    if ((bdual > tolerance) & (2 * inside + 1 != size)).any():
+        return False
+    return True
+
+
 # Unit tests
 if __name__ == '__main__':
     import unittest, math
@@ -939,7 +1470,120 @@ if __name__ == '__main__':
             # create nested S-blossom, relabel as S, expand recursively
             self.assertEqual(maxWeightMatching([ (1,2,40), (1,3,40), (2,3,60), (2,4,55), (3,5,55), (4,5,50), (1,8,15), (5,7,30), (7,6,10), (8,10,10), (4,9,30) ]), [ -1, 2, 1, 5, 9, 3, 7, 6, 10, 4, 8 ])
 
+        def test40_dual(self):
+            # the returned dual gives every edge non-negative slack
+            # and every matched edge zero slack
+            edges = [ (1,2,9), (1,3,9), (2,3,10), (2,4,8), (3,5,8), (4,5,10), (5,6,6) ]
+            (mate, dual) = maxWeightMatching(edges, returndual=True)
+            self.assertEqual(mate, [ -1, 3, 4, 1, 2, 6, 5 ])
+            self.assertEqual(len(dual.blossom), 2)
+            for (i, j, wt) in edges:
+                s = edgeSlack(dual, i, j, wt)
+                self.assertTrue(s >= 0)
+                if mate[i] == j:
+                    self.assertEqual(s, 0)
+
+        def test43_checkmatching(self):
+            # the certificate checker accepts optimal solutions and
+            # rejects suboptimal or broken ones, with or without NumPy
+            global numpy
+            edges = [ (1,2,45), (1,7,45), (2,3,50), (3,4,45), (4,5,95), (4,6,94), (5,6,94), (6,7,50), (1,8,30), (3,11,35), (5,9,36), (7,10,26), (11,12,5) ]
+            for usenumpy in (True, False):
+                saved = numpy
+                if not usenumpy:
+                    numpy = None
+                try:
+                    for maxcard in (False, True):
+                        (mate, dual) = maxWeightMatching(edges, maxcard, True)
+                        self.assertTrue(dual.blossom)
+                        self.assertTrue(checkMatching(edges, mate, dual, maxcard))
+                        # a worse matching is not certified
+                        worse = list(mate)
+                        (i, j) = (11, worse[11])
+                        worse[i] = worse[j] = -1
+                        self.assertFalse(checkMatching(edges, worse, dual, maxcard))
+                        # nor is the optimum with an infeasible dual
+                        bad = dual._replace(vertex=[ d - 2 for d in dual.vertex ])
+                        self.assertFalse(checkMatching(edges, mate, bad, maxcard))
+                finally:
+                    numpy = saved
+
+        def test44_trace(self):
+            # tracing records the events without changing the result
+            import io
+            global TRACE
+            edges = [ (1,2,9), (1,3,8), (2,3,10), (1,4,5), (4,5,4), (1,6,3) ]
+            tracer = MatchingTracer()
+            TRACE = tracer
+            try:
+                mate = maxWeightMatching(edges)
+            finally:
+                TRACE = None
+            self.assertEqual(mate, maxWeightMatching(edges))
+            events = list(tracer.events())
+            names = [ e[1] for e in events ]
+            self.assertEqual(names[0], 'start')
+            self.assertEqual(names.count('augment'), 3)
+            self.assertEqual(names.count('addBlossom'), 1)
+            f = io.BytesIO()
+            tracer.dumpBinary(f)
+            f.seek(0)
+            self.assertEqual(list(MatchingTracer.readBinary(f)), events)
+            f = io.StringIO()
+            tracer.dumpJson(f)
+            self.assertEqual(len(f.getvalue().splitlines()), len(events))
+            # a small buffer keeps only the latest events
+            small = MatchingTracer(capacity=4)
+            for (seq, event, a, b, c, value) in events:
+                small.record(MatchingTracer.EVENTS.index(event), a, b, c, value)
+            self.assertEqual(list(small.events()), events[-4:])
+
+        def test50_dense(self):
+            # the dense variant finds matchings as good as the sparse one
+            import random
+            rng = random.Random(50)
+            for maxcard in (False, True):
+                for n in (1, 2, 7, 16):
+                    weights = [ [ rng.randint(-5, 30) for j in range(n) ]
+                                for i in range(n) ]
+                    forbidden = [ [ rng.random() < 0.3 for j in range(n) ]
+                                  for i in range(n) ]
+                    edges = [ (i, j, weights[i][j])
+                              for i in range(n) for j in range(i+1, n)
+                              if not forbidden[i][j] ]
+                    mate = maxWeightMatchingDense(weights, forbidden, maxcard)
+                    sparse = maxWeightMatching(edges, maxcard)
+                    sparse += (n - len(sparse)) * [ -1 ]
+                    total = lambda m: sum([ weights[i][m[i]]
+                                            for i in range(n) if i < m[i] ])
+                    self.assertEqual(len(mate), n)
+                    self.assertEqual(total(mate), total(sparse))
+                    self.assertEqual(mate.count(-1), sparse.count(-1))
+                    for i in range(n):
+                        if i < mate[i]:
+                            self.assertFalse(forbidden[i][mate[i]])
+
+        def test51_dense_dual(self):
+            # the dense variant without a mask matches the full graph and
+            # returns a dual that certifies it
+            weights = [ [ 0, 9, 9, 0, 0, 0, 0 ],
+                        [ 9, 0, 10, 8, 0, 0, 0 ],
+                        [ 9, 10, 0, 0, 8, 0, 0 ],
+                        [ 0, 8, 0, 0, 10, 0, 0 ],
+                        [ 0, 0, 8, 10, 0, 6, 0 ],
+                        [ 0, 0, 0, 0, 6, 0, 0 ],
+                        [ 0, 0, 0, 0, 0, 0, 0 ] ]
+            (mate, dual) = maxWeightMatchingDense(weights, returndual=True)
+            self.assertEqual(sum([ weights[i][mate[i]] for i in range(7)
+                                   if i < mate[i] ]), 23)
+            edges = [ (i, j, weights[i][j]) for i in range(7)
+                      for j in range(i+1, 7) ]
+            self.assertTrue(checkMatching(edges, mate, dual))
+            nothing = [ [ True ] * 7 ] * 7
+            self.assertEqual(maxWeightMatchingDense(weights, nothing), 7 * [ -1 ])
+
     CHECK_DELTA = True
+    CHECK_OPTIMUM = True
     unittest.main()
 
 # end
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# scheduler.py -- pairs many tournaments at once in a process pool
+#
+# maxWeightMatching is pure Python, so pairing in threads gains nothing under
+# the GIL. The scheduler loads each round in the caller's thread, where the
+# storage lives, and sends only the CPU-bound pairStandings to worker
+# processes, keeping at most one job per worker in flight and the rest in a
+# bounded priority queue.
+#
+# On Python 2, concurrent.futures comes from the futures backport
+# (pip install futures).
+#
+
+import heapq
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import tournament
+
+
+class SchedulerFull(RuntimeError):
+    """Raised when a job cannot be queued because the queue is full."""
+
+
+class PairingScheduler(object):
+    """Schedules swissPairings for many tournaments on a pool of workers.
+
+    Queued jobs start in order of deadline, earliest first, with jobs
+    without a deadline last. Among equal deadlines the largest tournament
+    starts first, since it takes longest to pair.
+
+    Args:
+      executor: the concurrent.futures executor to pair in, defaults to a
+        ProcessPoolExecutor of maxWorkers processes that the scheduler owns
+        and shuts down.
+      maxWorkers: the most jobs running at once, defaults to the number of
+        CPUs.
+      maxQueued: the most jobs waiting for a worker.
+    """
+
+    def __init__(self, executor=None, maxWorkers=None, maxQueued=1024):
+        self.maxWorkers = maxWorkers or multiprocessing.cpu_count()
+        self.maxQueued = maxQueued
+        self._ownsExecutor = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(self.maxWorkers)
+        self.executor = executor
+        self.closed = False
+        self._queue = []
+        self._order = itertools.count()
+        self._running = 0
+        self._changed = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.shutdown()
+
+    def __len__(self):
+        """Returns the number of jobs waiting for a worker."""
+        return len(self._queue)
+
+    def submit(self, tournId, session=None, deadline=None, block=True,
+               timeout=None, rng=None, maxBracketGap=None, topOpponents=None,
+               strategy='global', useCache=True):
+        """Queues the pairing of a tournament's next round.
+
+        The round is loaded from storage before this returns, so the
+        tournament must not change until the result is used.
+
+        Args:
+          tournId: the tournament to pair.
+          session: the storage to use, defaults to tournament.getSession().
+          deadline: when the pairings are needed, as a time.time() value,
+            or None if there is no hurry. Late jobs still run.
+          block: whether to wait for room when the queue is full.
+          timeout: the most seconds to wait for room, or None to wait for
+            as long as it takes.
+          rng, maxBracketGap, topOpponents, strategy, useCache: as for
+            tournament.swissPairings. Pairings found in the pairing cache
+            are returned without queueing, and the pairings made are
+            cached.
+
+        Returns:
+          A Future whose result is the list of pairs swissPairings returns.
+          Cancelling it before it starts drops the job.
+
+        Raises:
+          RuntimeError: if the round is not complete, or the scheduler is
+            shut down.
+          SchedulerFull: if the queue stayed full.
+        """
+        storage = tournament._storage(session)
+        future = Future()
+        options = tournament._pairingOptions(
+            maxBracketGap, topOpponents, strategy)
+        cache = tournament.pairingCache(storage) if useCache else None
+        if cache is not None:
+            cached = cache.get(tournId, options)
+            if cached is not None:
+                future.set_result(cached)
+                return future
+            generation = cache.generation(tournId)
+
+        snapshot = tournament._loadRound(tournId, storage)
+        args = (snapshot.standings, snapshot.played, snapshot.eligible, rng,
+                maxBracketGap, topOpponents, strategy)
+        store = None
+        if cache is not None:
+            # Dropped by the cache if the tournament changes before then.
+            store = lambda pairings: cache.put(
+                tournId, snapshot.round, hash(snapshot.played), options,
+                pairings, generation)
+        priority = (deadline if deadline is not None else float('inf'),
+                    -len(snapshot.standings), next(self._order))
+
+        with self._changed:
+            if timeout is not None:
+                endtime = time.time() + timeout
+            while not self.closed and len(self._queue) >= self.maxQueued:
+                if not block:
+                    raise SchedulerFull('Pairing queue is full')
+                if timeout is None:
+                    self._changed.wait()
+                else:
+                    remaining = endtime - time.time()
+                    if remaining <= 0:
+                        raise SchedulerFull('Pairing queue is full')
+                    self._changed.wait(remaining)
+            if self.closed:
+                raise RuntimeError('Cannot submit after shutdown')
+            heapq.heappush(self._queue, (priority, future, args, store))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """Starts queued jobs while workers are free. Holds self._changed."""
+        while self._queue and self._running < self.maxWorkers:
+            priority, future, args, store = heapq.heappop(self._queue)
+            self._changed.notify_all()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                job = self.executor.submit(tournament.pairStandings, *args)
+            except Exception as error:
+                # A broken or shut down executor; the job never runs.
+                future.set_exception(error)
+                continue
+            self._running += 1
+            job.add_done_callback(
+                lambda job, future=future, store=store:
+                self._finish(job, future, store))
+
+    def _finish(self, job, future, store):
+        """Hands a finished job's outcome to its future, caching the pairings
+        with store if given, and starts the next job."""
+        error = job.exception()
+        if error is None:
+            if store is not None:
+                store(job.result())
+            future.set_result(job.result())
+        else:
+            future.set_exception(error)
+        with self._changed:
+            self._running -= 1
+            self._changed.notify_all()
+            self._dispatch()
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stops accepting jobs.
+
+        Args:
+          wait: whether to wait until every queued and running job is done.
+          cancel: whether to cancel the jobs still queued.
+        """
+        with self._changed:
+            self.closed = True
+            if cancel:
+                for priority, future, args, store in self._queue:
+                    future.cancel()
+                    future.set_running_or_notify_cancel()
+                del self._queue[:]
+            self._changed.notify_all()
+            if wait:
+                while self._queue or self._running:
+                    self._changed.wait()
+        if self._ownsExecutor:
+            self.executor.shutdown(wait)
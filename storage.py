@@ -0,0 +1,1146 @@
+#!/usr/bin/env python
+#
+# storage.py -- storage backends for the Swiss-system tournament
+#
+# Every backend offers the same methods, one for each data access function
+# in tournament.py, and can be passed to those functions as their session.
+#
+
+import collections
+import contextlib
+import itertools
+import sqlite3
+import threading
+import time
+from array import array
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+import metrics
+
+
+DSN = "dbname=tournament"
+
+
+# A row of standings, as returned by playerStandings.
+Standing = collections.namedtuple(
+    'Standing', ['id', 'name', 'wins', 'matches_played'])
+
+
+# Everything pairing a tournament's next round needs, as returned by
+# roundSnapshot: whether the current round is complete, the number of the next
+# round, the standings as a tuple of Standings sorted by wins, a frozenset of
+# the pairKeys of the pairs that have played, and a frozenset of the ids of the
+# players who have not had a bye.
+RoundSnapshot = collections.namedtuple(
+    'RoundSnapshot',
+    ['tournId', 'round', 'complete', 'standings', 'played', 'eligible'])
+
+
+class IntegrityError(ValueError):
+    """Raised by MemoryStorage where a database would reject a write."""
+
+
+class MatchReportError(ValueError):
+    """Raised by reportMatches when some of the results are invalid.
+
+    Attributes:
+      errors: a list of (index, result, reason) tuples, one for each invalid
+        result, where index is its position in the reported results.
+    """
+
+    def __init__(self, errors):
+        ValueError.__init__(
+            self, '%i invalid match result(s), first: %r at index %i: %s' % (
+                len(errors), errors[0][1], errors[0][0], errors[0][2]))
+        self.errors = errors
+
+
+def pairKey(playerA, playerB):
+    """Packs an unordered pair of player ids into a single integer.
+
+    Args:
+        playerA: id of player
+        playerB: id of other player
+
+    Returns:
+        integer: the same value whichever order the players are given in.
+    """
+    player0, player1 = max(playerA, playerB), min(playerA, playerB)
+    return player0 << 32 | player1
+
+
+def _checkResults(results, players, played, byes):
+    """Validates a batch of match results against a tournament's history.
+
+    Args:
+      results: an iterable of (winner, loser) pairs, loser None for a bye.
+      players: container of the ids of players entered in the tournament.
+      played: container of the pairKeys of pairs that have played.
+      byes: container of the ids of players who have had a bye.
+
+    Returns:
+      A list of the results, once every one has been checked.
+
+    Raises:
+      MatchReportError: if any result is invalid, listing every bad result.
+    """
+    checked, errors = [], []
+    newPairs, newByes = set(), set()
+    for index, result in enumerate(results):
+        winner, loser = result
+        if winner not in players:
+            reason = 'winner is not registered for the tournament'
+        elif loser is not None and loser not in players:
+            reason = 'loser is not registered for the tournament'
+        elif winner == loser:
+            reason = 'player cannot play themselves'
+        elif loser is None and (winner in byes or winner in newByes):
+            reason = 'player has already had a bye'
+        elif loser is not None and (pairKey(winner, loser) in played or
+                                    pairKey(winner, loser) in newPairs):
+            reason = 'players have already played'
+        else:
+            if loser is None:
+                newByes.add(winner)
+            else:
+                newPairs.add(pairKey(winner, loser))
+            checked.append((winner, loser))
+            continue
+        errors.append((index, result, reason))
+    if errors:
+        raise MatchReportError(errors)
+    return checked
+
+
+def _roundSnapshot(tournId, rows):
+    """Builds a RoundSnapshot from the rows of a snapshot query.
+
+    Args:
+      tournId: the tournament.
+      rows: (kind, id, name, a, b) rows. Kind 0 rows are standings, with a
+        and b the wins and matches played; kind 1 rows are matches, with id
+        and a being player0 and player1.
+    """
+    standings, played, byes = [], set(), set()
+    for kind, id_, name, a, b in rows:
+        if kind == 0:
+            standings.append(Standing(id_, name, a, b))
+        elif a is None:
+            byes.add(id_)
+        else:
+            played.add(pairKey(id_, a))
+    standings.sort(key=lambda player: (-player.wins, player.id))
+    counts = [player.matches_played for player in standings]
+    return RoundSnapshot(
+        tournId,
+        max(counts + [0]) + 1,
+        not counts or min(counts) == max(counts),
+        tuple(standings),
+        frozenset(played),
+        frozenset(player.id for player in standings if player.id not in byes))
+
+
+def _matchRow(tourn, winner, loser):
+    """Returns the (tourn, player0, player1, winner) row for a match."""
+    if loser is None:
+        return (tourn, winner, None, winner)
+    return (tourn, max(winner, loser), min(winner, loser), winner)
+
+
+class PostgresStorage(object):
+    """The tournament database in PostgreSQL, reached through a pool of
+    reusable connections.
+
+    Args:
+      dsn: connection string passed to psycopg2.connect.
+      minSize: number of connections opened up front and kept open.
+      maxSize: maximum number of connections open at once. Once the pool is
+        exhausted callers block until a connection is returned.
+      idleTimeout: seconds a connection may sit unused in the pool before it
+        is closed, or None to keep idle connections forever.
+      healthCheckInterval: connections idle for longer than this many seconds
+        are tested with a trivial query before being handed out. 0 tests on
+        every checkout, None never tests.
+    """
+
+    def __init__(self, dsn=DSN, minSize=1, maxSize=10, idleTimeout=300,
+                 healthCheckInterval=30):
+        if maxSize < 1 or not 0 <= minSize <= maxSize:
+            raise ValueError('Need 0 <= minSize <= maxSize and maxSize >= 1')
+        self.dsn = dsn
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.healthCheckInterval = healthCheckInterval
+        self.closed = False
+        # Idle connections as (connection, time returned) pairs. Used as a
+        # stack, so the least recently used connections sink to the bottom and
+        # are the ones reaped by the idle timeout.
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxSize)
+        now = time.time()
+        for _ in range(minSize):
+            self._idle.append((psycopg2.connect(dsn), now))
+
+    @metrics.timed('storage.checkout')
+    def getConn(self):
+        """Takes a connection from the pool, opening a new one if none is idle.
+
+        Returns:
+          A psycopg2 connection, which must be handed back with putConn.
+        """
+        if self.closed:
+            raise psycopg2.pool.PoolError('Session is closed')
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, returned = self._idle.pop()
+                if self._usable(conn, time.time() - returned):
+                    return conn
+                conn.close()
+            metrics.increment('storage.connects')
+            return psycopg2.connect(self.dsn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putConn(self, conn, discard=False):
+        """Returns a connection taken with getConn to the pool.
+
+        Args:
+          conn: the connection.
+          discard: close the connection instead of keeping it for reuse.
+        """
+        try:
+            if not (discard or self.closed or conn.closed):
+                if (conn.get_transaction_status() !=
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    conn.rollback()
+                with self._lock:
+                    self._idle.append((conn, time.time()))
+                    stale = self._reap()
+                conn = None
+            else:
+                stale = [conn]
+        except psycopg2.Error:
+            stale = [conn]
+        finally:
+            self._slots.release()
+        for conn in stale:
+            if not conn.closed:
+                conn.close()
+
+    def _reap(self):
+        """Removes connections idle past idleTimeout, keeping minSize open.
+
+        Must be called with the lock held. Returns the removed connections.
+        """
+        if self.idleTimeout is None:
+            return []
+        deadline = time.time() - self.idleTimeout
+        stale = []
+        while (len(self._idle) > self.minSize and
+               self._idle[0][1] < deadline):
+            stale.append(self._idle.pop(0)[0])
+        return stale
+
+    def _usable(self, conn, idleFor):
+        """Returns whether an idle connection can be handed out."""
+        if conn.closed:
+            return False
+        if self.idleTimeout is not None and idleFor > self.idleTimeout:
+            return False
+        if (self.healthCheckInterval is None or
+                idleFor < self.healthCheckInterval):
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def cursor(self, cursor_factory=None):
+        """Yields a cursor on a pooled connection.
+
+        The transaction is committed when the block exits normally and rolled
+        back if it raises, then the connection goes back to the pool.
+        """
+        conn = self.getConn()
+        try:
+            yield metrics.cursor(conn.cursor(cursor_factory=cursor_factory))
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            self.putConn(conn, discard=conn.closed)
+            raise
+        self.putConn(conn)
+
+    def close(self):
+        """Closes all idle connections; connections in use are closed when
+        they are returned."""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def deleteMatches(self):
+        sql = '''
+            DELETE FROM matches;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql)
+
+    def deletePlayers(self):
+        sql = '''
+            DELETE FROM players;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql)
+
+    def deleteTournaments(self):
+        sql = '''
+            DELETE FROM tournaments;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql)
+
+    def deleteTournamentPlayers(self):
+        sql = '''
+            DELETE FROM tournament_players;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql)
+
+    def countPlayers(self):
+        sql = '''
+            SELECT count(*) FROM players;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql)
+            return cur.fetchone()[0]
+
+    def countTournamentPlayers(self, tournId):
+        sql = '''
+            SELECT count(*)
+            FROM tournament_players
+            WHERE tourn=%s;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId,))
+            return cur.fetchone()[0]
+
+    def registerTournament(self, name):
+        sql = '''
+            INSERT INTO tournaments (name) VALUES (%s)
+            RETURNING id;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (name,))
+            return cur.fetchone()[0]
+
+    def registerPlayer(self, name):
+        sql = '''
+            INSERT INTO players (name) VALUES (%s)
+            RETURNING id;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (name,))
+            return cur.fetchone()[0]
+
+    def registerPlayerForTournament(self, tournId, playerId):
+        sql = '''
+            INSERT INTO tournament_players (tourn, player)
+            VALUES (%s, %s);
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId, playerId))
+
+    def registerPlayers(self, names, tournId=None, batchSize=1000):
+        sql = '''
+            INSERT INTO players (name) VALUES %s
+            RETURNING id;
+        '''
+        ids = []
+        names = iter(names)
+        with self.cursor() as cur:
+            while True:
+                batch = [(name,) for name in itertools.islice(names, batchSize)]
+                if not batch:
+                    break
+                # Serial ids are drawn in row order within one statement, so
+                # sorting them restores the input order even if RETURNING
+                # doesn't.
+                batchIds = sorted(
+                    id_ for (id_,) in psycopg2.extras.execute_values(
+                        cur, sql, batch, page_size=len(batch), fetch=True))
+                if tournId is not None:
+                    self._insertTournamentPlayers(cur, tournId, batchIds)
+                ids.extend(batchIds)
+        return ids
+
+    def registerPlayersForTournament(self, tournId, playerIds, batchSize=1000):
+        playerIds = iter(playerIds)
+        with self.cursor() as cur:
+            while True:
+                batch = list(itertools.islice(playerIds, batchSize))
+                if not batch:
+                    break
+                self._insertTournamentPlayers(cur, tournId, batch)
+
+    def _insertTournamentPlayers(self, cur, tournId, playerIds):
+        """Enters playerIds in a tournament using an open cursor."""
+        sql = '''
+            INSERT INTO tournament_players (tourn, player) VALUES %s;
+        '''
+        psycopg2.extras.execute_values(
+            cur, sql, [(tournId, id_) for id_ in playerIds],
+            page_size=len(playerIds))
+
+    def playerStandings(self, tournId):
+        sql = '''
+            SELECT id, name, wins, matches_played
+            FROM standings
+            WHERE tourn=%s;
+        '''
+        with self.cursor(psycopg2.extras.NamedTupleCursor) as cur:
+            cur.execute(sql, (tournId,))
+            return cur.fetchall()
+
+    def iterStandings(self, tournId, itersize=2000):
+        sql = '''
+            SELECT id, name, wins, matches_played
+            FROM standings
+            WHERE tourn=%s;
+        '''
+        # A named cursor is a server-side cursor, read itersize rows at a
+        # time, holding a pooled connection until the generator finishes.
+        conn = self.getConn()
+        try:
+            cur = conn.cursor('standings')
+            cur.itersize = itersize
+            cur = metrics.cursor(cur)
+            try:
+                cur.execute(sql, (tournId,))
+                for row in cur:
+                    yield row
+            finally:
+                cur.close()
+            conn.commit()
+        finally:
+            self.putConn(conn, discard=conn.closed)
+
+    def roundSnapshot(self, tournId):
+        sql = '''
+            SELECT 0 AS kind, id, name, wins, matches_played
+            FROM standings
+            WHERE tourn = %(tourn)s
+            UNION ALL
+            SELECT 1, player0, NULL, player1, NULL
+            FROM matches
+            WHERE tourn = %(tourn)s;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, {'tourn': tournId})
+            return _roundSnapshot(tournId, cur)
+
+    def rebuildStandings(self, tournId):
+        sql = '''
+            SELECT rebuild_standings(%s);
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId,))
+
+    def reportMatch(self, tourn, winner, loser=None):
+        sql = '''
+            INSERT INTO matches (tourn, player0, player1, winner)
+            VALUES (%s, %s, %s, %s);
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, _matchRow(tourn, winner, loser))
+
+    def reportMatches(self, tourn, results):
+        playersSql = '''
+            SELECT player FROM tournament_players WHERE tourn = %s;
+        '''
+        matchesSql = '''
+            SELECT player0, player1 FROM matches WHERE tourn = %s;
+        '''
+        insertSql = '''
+            INSERT INTO matches (tourn, player0, player1, winner)
+            VALUES %s;
+        '''
+        with self.cursor() as cur:
+            cur.execute(playersSql, (tourn,))
+            players = set(player for (player,) in cur)
+            cur.execute(matchesSql, (tourn,))
+            played, byes = set(), set()
+            for player0, player1 in cur:
+                if player1 is None:
+                    byes.add(player0)
+                else:
+                    played.add(pairKey(player0, player1))
+            results = _checkResults(results, players, played, byes)
+            psycopg2.extras.execute_values(
+                cur, insertSql,
+                [_matchRow(tourn, winner, loser) for winner, loser in results])
+
+    def roundComplete(self, tourn):
+        sql = '''
+            SELECT coalesce(min(matches_played) = max(matches_played), true)
+            FROM player_standings
+            WHERE tourn = %s;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return cur.fetchall()[0][0]
+
+    def haveAlreadyPlayed(self, tourn, playerA, playerB):
+        sql = """
+            SELECT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE tourn = %s
+                AND player0 = %s
+                AND player1 = %s
+            );
+        """
+        player0, player1 = max(playerA, playerB), min(playerA, playerB)
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn, player0, player1))
+            return cur.fetchall()[0][0]
+
+    def playedPairs(self, tourn):
+        sql = """
+            SELECT player0, player1
+            FROM matches
+            WHERE tourn = %s
+            AND player1 IS NOT NULL;
+        """
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return set(player0 << 32 | player1 for player0, player1 in cur)
+
+    def byeEligible(self, tourn):
+        sql = """
+            SELECT player
+            FROM tournament_players
+            WHERE tourn = %s
+            AND NOT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE matches.tourn = tournament_players.tourn
+                AND matches.player0 = tournament_players.player
+                AND matches.player1 IS NULL
+            );
+        """
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return set(player for (player,) in cur)
+
+    def pairingEdges(self, tourn, excluded=None, maxBracketGap=None):
+        sql = '''
+            SELECT player_a, player_b, weight
+            FROM pairing_edges(%s, %s, %s);
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn, excluded, maxBracketGap))
+            return cur.fetchall()
+
+    def hadBye(self, tourn, player):
+        sql = """
+            SELECT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE tourn = %s
+                AND player0 = %s
+                AND player1 IS NULL
+            );
+        """
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn, player))
+            return cur.fetchall()[0][0]
+
+
+# The tournament schema for SQLite, following tournament.sql. Standings are
+# aggregated on read; SQLiteStorage is a stand-in for tests and small events.
+SQLITE_SCHEMA = '''
+    PRAGMA foreign_keys = ON;
+
+    CREATE TABLE IF NOT EXISTS players (
+        id      integer PRIMARY KEY AUTOINCREMENT,
+        name    varchar(40) NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS tournaments (
+        id      integer PRIMARY KEY AUTOINCREMENT,
+        name    varchar(40) NOT NULL,
+        winner  integer REFERENCES players (id)
+    );
+
+    CREATE TABLE IF NOT EXISTS tournament_players (
+        tourn   integer NOT NULL REFERENCES tournaments (id),
+        player  integer NOT NULL REFERENCES players (id),
+        UNIQUE (tourn, player)
+    );
+
+    CREATE TABLE IF NOT EXISTS matches (
+        id      integer PRIMARY KEY AUTOINCREMENT,
+        tourn   integer NOT NULL REFERENCES tournaments (id),
+        player0 integer NOT NULL REFERENCES players (id),
+        player1 integer REFERENCES players (id),
+        winner  integer NOT NULL,
+        CHECK (player0 > player1),
+        UNIQUE (tourn, player0, player1),
+        FOREIGN KEY (tourn, player0)
+            REFERENCES tournament_players (tourn, player),
+        FOREIGN KEY (tourn, player1)
+            REFERENCES tournament_players (tourn, player),
+        CHECK (winner = player0 or winner = player1)
+    );
+
+    CREATE INDEX IF NOT EXISTS matches_player1 ON matches (tourn, player1);
+
+    CREATE VIEW IF NOT EXISTS match_players AS
+    SELECT tourn, player0 AS player, winner
+    FROM matches
+    UNION ALL
+    SELECT tourn, player1 AS player, winner
+    FROM matches
+    WHERE player1 IS NOT NULL;
+
+    CREATE VIEW IF NOT EXISTS standings AS
+    SELECT
+        players.id,
+        players.name,
+        count(CASE WHEN match_players.player = winner THEN 1 END) AS wins,
+        count(match_players.player) AS matches_played,
+        tournament_players.tourn
+    FROM tournament_players JOIN players
+    ON players.id = tournament_players.player
+    LEFT JOIN match_players
+    ON match_players.tourn = tournament_players.tourn
+    AND match_players.player = tournament_players.player
+    GROUP BY tournament_players.tourn, players.id;
+'''
+
+
+class SQLiteStorage(object):
+    """The tournament database in SQLite, a stand-in for PostgreSQL.
+
+    Args:
+      path: the database file, by default a private in-memory database.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.closed = False
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Yields a cursor, committing when the block exits normally and
+        rolling back if it raises."""
+        with self._lock:
+            cur = metrics.cursor(self._conn.cursor())
+            try:
+                yield cur
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def close(self):
+        """Closes the database."""
+        self.closed = True
+        self._conn.close()
+
+    def deleteMatches(self):
+        with self.cursor() as cur:
+            cur.execute('DELETE FROM matches;')
+
+    def deletePlayers(self):
+        with self.cursor() as cur:
+            cur.execute('DELETE FROM players;')
+
+    def deleteTournaments(self):
+        with self.cursor() as cur:
+            cur.execute('DELETE FROM tournaments;')
+
+    def deleteTournamentPlayers(self):
+        with self.cursor() as cur:
+            cur.execute('DELETE FROM tournament_players;')
+
+    def countPlayers(self):
+        with self.cursor() as cur:
+            cur.execute('SELECT count(*) FROM players;')
+            return cur.fetchone()[0]
+
+    def countTournamentPlayers(self, tournId):
+        sql = '''
+            SELECT count(*)
+            FROM tournament_players
+            WHERE tourn=?;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId,))
+            return cur.fetchone()[0]
+
+    def registerTournament(self, name):
+        with self.cursor() as cur:
+            cur.execute('INSERT INTO tournaments (name) VALUES (?);', (name,))
+            return cur.lastrowid
+
+    def registerPlayer(self, name):
+        with self.cursor() as cur:
+            cur.execute('INSERT INTO players (name) VALUES (?);', (name,))
+            return cur.lastrowid
+
+    def registerPlayerForTournament(self, tournId, playerId):
+        self.registerPlayersForTournament(tournId, [playerId])
+
+    def registerPlayers(self, names, tournId=None, batchSize=1000):
+        ids = []
+        with self.cursor() as cur:
+            for name in names:
+                cur.execute('INSERT INTO players (name) VALUES (?);', (name,))
+                ids.append(cur.lastrowid)
+                if tournId is not None:
+                    cur.execute('''
+                        INSERT INTO tournament_players (tourn, player)
+                        VALUES (?, ?);
+                    ''', (tournId, cur.lastrowid))
+        return ids
+
+    def registerPlayersForTournament(self, tournId, playerIds, batchSize=1000):
+        sql = '''
+            INSERT INTO tournament_players (tourn, player)
+            VALUES (?, ?);
+        '''
+        with self.cursor() as cur:
+            cur.executemany(sql, ((tournId, id_) for id_ in playerIds))
+
+    def playerStandings(self, tournId):
+        sql = '''
+            SELECT id, name, wins, matches_played
+            FROM standings
+            WHERE tourn=?
+            ORDER BY wins DESC, id;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId,))
+            return [Standing(*row) for row in cur]
+
+    def iterStandings(self, tournId, itersize=2000):
+        sql = '''
+            SELECT id, name, wins, matches_played
+            FROM standings
+            WHERE tourn=?
+            ORDER BY wins DESC, id;
+        '''
+        # SQLite steps through the result as it is read; the database is
+        # locked to other threads until the generator finishes.
+        with self.cursor() as cur:
+            cur.execute(sql, (tournId,))
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+
+    def roundSnapshot(self, tournId):
+        sql = '''
+            SELECT 0 AS kind, id, name, wins, matches_played
+            FROM standings
+            WHERE tourn = :tourn
+            UNION ALL
+            SELECT 1, player0, NULL, player1, NULL
+            FROM matches
+            WHERE tourn = :tourn;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, {'tourn': tournId})
+            return _roundSnapshot(tournId, cur)
+
+    def rebuildStandings(self, tournId):
+        # Standings are aggregated on every read.
+        pass
+
+    def reportMatch(self, tourn, winner, loser=None):
+        sql = '''
+            INSERT INTO matches (tourn, player0, player1, winner)
+            VALUES (?, ?, ?, ?);
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, _matchRow(tourn, winner, loser))
+
+    def reportMatches(self, tourn, results):
+        insertSql = '''
+            INSERT INTO matches (tourn, player0, player1, winner)
+            VALUES (?, ?, ?, ?);
+        '''
+        with self.cursor() as cur:
+            cur.execute(
+                'SELECT player FROM tournament_players WHERE tourn = ?;',
+                (tourn,))
+            players = set(player for (player,) in cur)
+            cur.execute(
+                'SELECT player0, player1 FROM matches WHERE tourn = ?;',
+                (tourn,))
+            played, byes = set(), set()
+            for player0, player1 in cur:
+                if player1 is None:
+                    byes.add(player0)
+                else:
+                    played.add(pairKey(player0, player1))
+            results = _checkResults(results, players, played, byes)
+            cur.executemany(
+                insertSql,
+                [_matchRow(tourn, winner, loser) for winner, loser in results])
+
+    def roundComplete(self, tourn):
+        sql = '''
+            SELECT coalesce(min(matches_played) = max(matches_played), 1)
+            FROM standings
+            WHERE tourn = ?;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return bool(cur.fetchone()[0])
+
+    def haveAlreadyPlayed(self, tourn, playerA, playerB):
+        return pairKey(playerA, playerB) in self.playedPairs(tourn)
+
+    def playedPairs(self, tourn):
+        sql = '''
+            SELECT player0, player1
+            FROM matches
+            WHERE tourn = ?
+            AND player1 IS NOT NULL;
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return set(player0 << 32 | player1 for player0, player1 in cur)
+
+    def byeEligible(self, tourn):
+        sql = '''
+            SELECT player
+            FROM tournament_players
+            WHERE tourn = ?
+            AND NOT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE matches.tourn = tournament_players.tourn
+                AND matches.player0 = tournament_players.player
+                AND matches.player1 IS NULL
+            );
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn,))
+            return set(player for (player,) in cur)
+
+    def pairingEdges(self, tourn, excluded=None, maxBracketGap=None):
+        # The query of tournament.sql's pairing_edges function.
+        sql = '''
+            WITH ranked AS (
+                SELECT id AS player, wins, matches_played,
+                       dense_rank() OVER (ORDER BY wins DESC) AS bracket
+                FROM standings
+                WHERE tourn = :tourn
+                AND id IS NOT :excluded
+            )
+            SELECT a.player, b.player, a.matches_played - abs(a.wins - b.wins)
+            FROM ranked AS a JOIN ranked AS b
+            ON a.player > b.player
+            WHERE (:gap IS NULL OR abs(a.bracket - b.bracket) <= :gap)
+            AND NOT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE matches.tourn = :tourn
+                AND matches.player0 = a.player
+                AND matches.player1 = b.player
+            );
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, {'tourn': tourn, 'excluded': excluded,
+                              'gap': maxBracketGap})
+            return cur.fetchall()
+
+    def hadBye(self, tourn, player):
+        sql = '''
+            SELECT EXISTS (
+                SELECT *
+                FROM matches
+                WHERE tourn = ?
+                AND player0 = ?
+                AND player1 IS NULL
+            );
+        '''
+        with self.cursor() as cur:
+            cur.execute(sql, (tourn, player))
+            return bool(cur.fetchone()[0])
+
+
+class _MemoryTournament(object):
+    """A tournament's players and results, held in arrays indexed by the
+    order in which players were entered."""
+
+    __slots__ = ('name', 'ids', 'index', 'wins', 'played', 'byes', 'pairs',
+                 'matchCount')
+
+    def __init__(self, name):
+        self.name = name
+        # ids[i] is the id of the i'th player entered, index maps back.
+        self.ids = array('l')
+        self.index = {}
+        self.wins = array('l')
+        self.played = array('l')
+        # byes[i] is 1 once player i has had a bye.
+        self.byes = bytearray()
+        # pairKeys of the pairs that have played each other.
+        self.pairs = set()
+        self.matchCount = 0
+
+    def enter(self, playerId):
+        self.index[playerId] = len(self.ids)
+        self.ids.append(playerId)
+        self.wins.append(0)
+        self.played.append(0)
+        self.byes.append(0)
+
+    def clearMatches(self):
+        n = len(self.ids)
+        self.wins = array('l', [0]) * n
+        self.played = array('l', [0]) * n
+        self.byes = bytearray(n)
+        self.pairs = set()
+        self.matchCount = 0
+
+
+class MemoryStorage(object):
+    """The tournament database held in memory, for simulations, pairing
+    previews and load tests.
+
+    Writes are checked against the same constraints as tournament.sql, and
+    raise IntegrityError where the database would refuse them.
+    """
+
+    def __init__(self):
+        self.closed = False
+        self._names = {}
+        self._tournaments = {}
+        self._nextPlayerId = 1
+        self._nextTournamentId = 1
+        self._lock = threading.RLock()
+
+    def close(self):
+        self.closed = True
+
+    def _tournament(self, tournId):
+        try:
+            return self._tournaments[tournId]
+        except KeyError:
+            raise IntegrityError('No tournament with id %r' % (tournId,))
+
+    def deleteMatches(self):
+        with self._lock:
+            for tourn in self._tournaments.values():
+                tourn.clearMatches()
+
+    def deletePlayers(self):
+        with self._lock:
+            if any(tourn.ids for tourn in self._tournaments.values()):
+                raise IntegrityError('Players are entered in tournaments')
+            self._names.clear()
+
+    def deleteTournaments(self):
+        with self._lock:
+            if any(tourn.ids for tourn in self._tournaments.values()):
+                raise IntegrityError('Tournaments have players entered')
+            self._tournaments.clear()
+
+    def deleteTournamentPlayers(self):
+        with self._lock:
+            if any(tourn.matchCount for tourn in self._tournaments.values()):
+                raise IntegrityError('Tournament players have matches')
+            for tournId, tourn in self._tournaments.items():
+                self._tournaments[tournId] = _MemoryTournament(tourn.name)
+
+    def countPlayers(self):
+        return len(self._names)
+
+    def countTournamentPlayers(self, tournId):
+        tourn = self._tournaments.get(tournId)
+        return len(tourn.ids) if tourn else 0
+
+    def registerTournament(self, name):
+        with self._lock:
+            id_ = self._nextTournamentId
+            self._nextTournamentId += 1
+            self._tournaments[id_] = _MemoryTournament(name)
+            return id_
+
+    def registerPlayer(self, name):
+        with self._lock:
+            id_ = self._nextPlayerId
+            self._nextPlayerId += 1
+            self._names[id_] = name
+            return id_
+
+    def registerPlayerForTournament(self, tournId, playerId):
+        self.registerPlayersForTournament(tournId, [playerId])
+
+    def registerPlayers(self, names, tournId=None, batchSize=1000):
+        with self._lock:
+            tourn = None if tournId is None else self._tournament(tournId)
+            ids = [self.registerPlayer(name) for name in names]
+            if tourn is not None:
+                for id_ in ids:
+                    tourn.enter(id_)
+            return ids
+
+    def registerPlayersForTournament(self, tournId, playerIds, batchSize=1000):
+        with self._lock:
+            tourn = self._tournament(tournId)
+            playerIds = list(playerIds)
+            for id_ in playerIds:
+                if id_ not in self._names:
+                    raise IntegrityError('No player with id %r' % (id_,))
+            if (len(set(playerIds)) != len(playerIds) or
+                    any(id_ in tourn.index for id_ in playerIds)):
+                raise IntegrityError('Player already entered in tournament')
+            for id_ in playerIds:
+                tourn.enter(id_)
+
+    def playerStandings(self, tournId):
+        tourn = self._tournaments.get(tournId)
+        if tourn is None:
+            return []
+        ids, wins, played, names = (
+            tourn.ids, tourn.wins, tourn.played, self._names)
+        order = sorted(range(len(ids)), key=lambda i: (-wins[i], ids[i]))
+        return [Standing(ids[i], names[ids[i]], wins[i], played[i])
+                for i in order]
+
+    def iterStandings(self, tournId, itersize=2000):
+        tourn = self._tournaments.get(tournId)
+        if tourn is None:
+            return
+        with self._lock:
+            ids, wins = tourn.ids, tourn.wins
+            order = array('l', sorted(range(len(ids)),
+                                      key=lambda i: (-wins[i], ids[i])))
+            ids, wins, played = (
+                array('l', ids), array('l', wins), array('l', tourn.played))
+        names = self._names
+        for i in order:
+            yield (ids[i], names[ids[i]], wins[i], played[i])
+
+    def roundSnapshot(self, tournId):
+        with self._lock:
+            tourn = self._tournaments.get(tournId)
+            if tourn is None:
+                return _roundSnapshot(tournId, [])
+            names = self._names
+            rows = [(0, id_, names[id_], tourn.wins[i], tourn.played[i])
+                    for i, id_ in enumerate(tourn.ids)]
+            byes = [id_ for i, id_ in enumerate(tourn.ids) if tourn.byes[i]]
+            snapshot = _roundSnapshot(tournId, rows)
+            return snapshot._replace(
+                played=frozenset(tourn.pairs),
+                eligible=snapshot.eligible.difference(byes))
+
+    def rebuildStandings(self, tournId):
+        # The arrays are the only copy of the standings.
+        pass
+
+    def reportMatch(self, tourn, winner, loser=None):
+        try:
+            self.reportMatches(tourn, [(winner, loser)])
+        except MatchReportError as e:
+            raise IntegrityError(e.errors[0][2])
+
+    def reportMatches(self, tourn, results):
+        with self._lock:
+            tourn = self._tournament(tourn)
+            byes = set(tourn.ids[i] for i in range(len(tourn.ids))
+                       if tourn.byes[i])
+            results = _checkResults(results, tourn.index, tourn.pairs, byes)
+            index, wins, played = tourn.index, tourn.wins, tourn.played
+            for winner, loser in results:
+                w = index[winner]
+                wins[w] += 1
+                played[w] += 1
+                if loser is None:
+                    tourn.byes[w] = 1
+                else:
+                    played[index[loser]] += 1
+                    tourn.pairs.add(pairKey(winner, loser))
+            tourn.matchCount += len(results)
+
+    def roundComplete(self, tourn):
+        tourn = self._tournaments.get(tourn)
+        if tourn is None or not tourn.played:
+            return True
+        return min(tourn.played) == max(tourn.played)
+
+    def haveAlreadyPlayed(self, tourn, playerA, playerB):
+        tourn = self._tournaments.get(tourn)
+        return tourn is not None and pairKey(playerA, playerB) in tourn.pairs
+
+    def playedPairs(self, tourn):
+        tourn = self._tournaments.get(tourn)
+        return set(tourn.pairs) if tourn else set()
+
+    def byeEligible(self, tourn):
+        tourn = self._tournaments.get(tourn)
+        if tourn is None:
+            return set()
+        return set(tourn.ids[i] for i in range(len(tourn.ids))
+                   if not tourn.byes[i])
+
+    def pairingEdges(self, tourn, excluded=None, maxBracketGap=None):
+        with self._lock:
+            tourn = self._tournaments.get(tourn)
+            if tourn is None:
+                return []
+            ids, wins, played = tourn.ids, tourn.wins, tourn.played
+            players = [i for i in range(len(ids)) if ids[i] != excluded]
+            scores = sorted(set(wins[i] for i in players), reverse=True)
+            bracket = dict((score, b) for (b, score) in enumerate(scores))
+            edges = []
+            for a in players:
+                for b in players:
+                    if (ids[a] <= ids[b] or
+                            pairKey(ids[a], ids[b]) in tourn.pairs):
+                        continue
+                    if (maxBracketGap is not None and
+                            abs(bracket[wins[a]] - bracket[wins[b]]) >
+                            maxBracketGap):
+                        continue
+                    edges.append(
+                        (ids[a], ids[b], played[a] - abs(wins[a] - wins[b])))
+            return edges
+
+    def hadBye(self, tourn, player):
+        tourn = self._tournaments.get(tourn)
+        if tourn is None or player not in tourn.index:
+            return False
+        return bool(tourn.byes[tourn.index[player]])
@@ -3,130 +3,191 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import csv
+import json
 import random
+import threading
+import weakref
 
 import psycopg2
-import psycopg2.extras
 
-from mwmatching import maxWeightMatching
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import metrics
+from cache import PairingCache, StandingsCache
+from mwmatching import checkMatching, edgeSlack, maxWeightMatching
+from storage import (DSN, IntegrityError, MatchReportError, MemoryStorage,
+                     PostgresStorage, RoundSnapshot, SQLiteStorage, pairKey)
+
+
+# Fraction of pairings whose optimality certificate is checked, from 0 to 1.
+AUDIT_RATE = 0.0
+
+# Sessions are pooled PostgreSQL storage; any other storage backend can be
+# passed wherever a session is accepted.
+Session = PostgresStorage
 
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(DSN)
 
 
-def deleteMatches():
-    """Remove all the match records from the database."""
-    sql = '''
-        DELETE FROM matches;
-    '''
+_defaultSession = None
+_defaultSessionLock = threading.Lock()
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
 
+def getSession():
+    """Returns the default session, creating it on first use."""
+    global _defaultSession
+    with _defaultSessionLock:
+        if _defaultSession is None or _defaultSession.closed:
+            _defaultSession = Session()
+        return _defaultSession
 
-def deletePlayers():
-    """Remove all the player records from the database."""
-    sql = '''
-        DELETE FROM players;
-    '''
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
+def setSession(session):
+    """Replaces the default session used when no session is passed.
 
+    Args:
+      session: a Session or other storage backend, such as MemoryStorage, or
+        None to create a fresh Session on next use.
+    """
+    global _defaultSession
+    with _defaultSessionLock:
+        _defaultSession = session
 
-def deleteTournaments():
-    """Remove all the tournament records from the database."""
-    sql = '''
-        DELETE FROM tournaments;
-    '''
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
+def _storage(session):
+    """Returns session, or the default session if it is None."""
+    if session is None:
+        return getSession()
+    return session
 
 
-def deleteTournamentPlayers():
-    """Remove all the records from the tournament_players table."""
-    sql = '''
-        DELETE FROM tournament_players;
-    '''
+# Each session's caches, by class.
+_caches = weakref.WeakKeyDictionary()
+_cachesLock = threading.Lock()
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql)
-    conn.commit()
-    conn.close()
 
+def _cache(storage, cls):
+    """Returns a session's cache of the given class, creating it if need be."""
+    with _cachesLock:
+        caches = _caches.setdefault(storage, {})
+        cache = caches.get(cls)
+        if cache is None:
+            cache = caches[cls] = cls()
+        return cache
 
-def countPlayers():
-    """Returns the number of players currently registered."""
-    sql = '''
-        SELECT count(*) FROM players;
-    '''
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql)
-    result = cur.fetchone()[0]
-    conn.close()
-    return result
+def pairingCache(session=None):
+    """Returns the cache of a session's swissPairings results.
+
+    Each session has its own PairingCache, created on first use, whose limits
+    can be changed through its maxEntries and maxPairs attributes.
+
+    Args:
+      session: the storage to use, defaults to getSession().
+    """
+    return _cache(_storage(session), PairingCache)
+
+
+def standingsCache(session=None):
+    """Returns the cache of a session's standings, see StandingsCache.
+
+    Args:
+      session: the storage to use, defaults to getSession().
+    """
+    return _cache(_storage(session), StandingsCache)
+
+
+def _generations(storage, tournId):
+    """Returns the generation of a tournament in each of a session's caches,
+    to be taken before writing matches and passed to _invalidate."""
+    return dict((cache, cache.generation(tournId))
+                for cache in list(_caches.get(storage, {}).values()))
+
+
+def _invalidate(storage, tournId=None, results=None,
+                generations=None):
+    """Brings a session's caches up to date after a tournament changed.
+
+    Args:
+      storage: the session written to.
+      tournId: the tournament changed, or None if any may have.
+      results: if the only change was reporting matches, their
+        (winner, loser) results.
+      generations: with results, the caches' generations of the tournament
+        from before the matches were written, see _generations.
+    """
+    generations = generations or {}
+    for cache in list(_caches.get(storage, {}).values()):
+        if results is None:
+            cache.invalidate(tournId)
+        else:
+            cache.record(tournId, results, generations.get(cache))
 
 
-def countTournamentPlayers(tournId):
+def deleteMatches(session=None):
+    """Remove all the match records from the database."""
+    storage = _storage(session)
+    storage.deleteMatches()
+    _invalidate(storage)
+
+
+def deletePlayers(session=None):
+    """Remove all the player records from the database."""
+    storage = _storage(session)
+    storage.deletePlayers()
+    _invalidate(storage)
+
+
+def deleteTournaments(session=None):
+    """Remove all the tournament records from the database."""
+    storage = _storage(session)
+    storage.deleteTournaments()
+    _invalidate(storage)
+
+
+def deleteTournamentPlayers(session=None):
+    """Remove all the records from the tournament_players table."""
+    storage = _storage(session)
+    storage.deleteTournamentPlayers()
+    _invalidate(storage)
+
+
+def countPlayers(session=None):
+    """Returns the number of players currently registered."""
+    return _storage(session).countPlayers()
+
+
+def countTournamentPlayers(tournId, session=None):
     """Returns the number of players currently registered for tournament.
 
     Args:
         tournId: the id of the tournament.
+        session: the storage to use, defaults to getSession().
     """
-    sql = '''
-        SELECT count(*)
-        FROM tournament_players
-        WHERE tourn=%s;
-    '''
-
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tournId,))
-    result = cur.fetchone()[0]
-    conn.close()
-    return result
+    return _storage(session).countTournamentPlayers(tournId)
 
 
-def registerTournament(name):
+def registerTournament(name, session=None):
     """Adds a tournament to the tournament database and return it's id.
 
     Args:
       name: the tournament's full name (need not be unique).
+      session: the storage to use, defaults to getSession().
 
     Returns:
       integer: the tournament's new id.
     """
+    return _storage(session).registerTournament(name)
 
-    sql = '''
-        INSERT INTO tournaments (name) VALUES (%s)
-        RETURNING id;
-    '''
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (name,))
-    id_ = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
-    return id_
-
-
-def registerPlayer(name):
+def registerPlayer(name, session=None):
     """Adds a player to the tournament database and return their id.
 
     The database assigns a unique serial id number for the player.  (This
@@ -134,46 +195,86 @@ def registerPlayer(name):
 
     Args:
       name: the player's full name (need not be unique).
+      session: the storage to use, defaults to getSession().
 
     Returns:
       integer: the player's new id.
     """
+    return _storage(session).registerPlayer(name)
 
-    sql = '''
-        INSERT INTO players (name) VALUES (%s)
-        RETURNING id;
-    '''
-
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (name,))
-    id_ = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
-    return id_
 
-
-def registerPlayerForTournament(tournId, playerId):
+def registerPlayerForTournament(tournId, playerId, session=None):
     """Adds a player to a tournament.
 
     Args:
       tournId: a tournament's id.
       playerId: a player's id.
+      session: the storage to use, defaults to getSession().
     """
+    storage = _storage(session)
+    storage.registerPlayerForTournament(tournId, playerId)
+    _invalidate(storage, tournId)
+
 
-    sql = '''
-        INSERT INTO tournament_players (tourn, player)
-        VALUES (%s, %s);
-    '''
+@metrics.timed('tournament.registerPlayers')
+def registerPlayers(names, tournId=None, session=None, batchSize=1000):
+    """Adds many players, and optionally enters them in a tournament.
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tournId, playerId))
-    conn.commit()
-    conn.close()
+    Everything is written in a single transaction, batchSize rows per
+    statement, so names can be any iterable (such as a generator reading a
+    file) and are never all held in memory at once.
 
+    Args:
+      names: an iterable of the players' full names.
+      tournId: if given, the tournament to enter every new player in.
+      session: the storage to use, defaults to getSession().
+      batchSize: the number of players inserted per statement.
 
-def playerStandings(tournId):
+    Returns:
+      A list of the players' new ids, in the same order as names.
+    """
+    storage = _storage(session)
+    ids = storage.registerPlayers(names, tournId, batchSize)
+    if tournId is not None:
+        _invalidate(storage, tournId)
+    return ids
+
+
+def registerPlayersFromCsv(csvfile, tournId=None, column='name',
+                           session=None, batchSize=1000):
+    """Adds a player for each row of a CSV file, see registerPlayers.
+
+    Args:
+      csvfile: an open file, or any iterable of lines, with a header row.
+      tournId: if given, the tournament to enter every new player in.
+      column: the header of the column holding the players' names.
+      session: the storage to use, defaults to getSession().
+      batchSize: the number of players inserted per statement.
+
+    Returns:
+      A list of the players' new ids, in file order.
+    """
+    names = (row[column] for row in csv.DictReader(csvfile))
+    return registerPlayers(names, tournId, session, batchSize)
+
+
+def registerPlayersForTournament(tournId, playerIds, session=None,
+                                 batchSize=1000):
+    """Adds many existing players to a tournament in a single transaction.
+
+    Args:
+      tournId: a tournament's id.
+      playerIds: an iterable of player ids.
+      session: the storage to use, defaults to getSession().
+      batchSize: the number of players inserted per statement.
+    """
+    storage = _storage(session)
+    storage.registerPlayersForTournament(tournId, playerIds, batchSize)
+    _invalidate(storage, tournId)
+
+
+@metrics.timed('tournament.playerStandings')
+def playerStandings(tournId, session=None, useCache=True):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a player
@@ -181,6 +282,9 @@ def playerStandings(tournId):
 
     Args:
       tournId: the tournament to get standings for.
+      session: the storage to use, defaults to getSession().
+      useCache: whether to use the session's standingsCache, which is only
+        kept up to date by changes made through this module.
 
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
@@ -189,44 +293,125 @@ def playerStandings(tournId):
         wins: the number of matches the player has won
         matches: the number of matches the player has played
     """
+    storage = _storage(session)
+    if useCache:
+        return standingsCache(storage).standings(
+            tournId, lambda: storage.playerStandings(tournId))
+    return storage.playerStandings(tournId)
+
+
+def iterStandings(tournId, session=None, itersize=2000):
+    """Yields a tournament's standings one row at a time, sorted by wins.
+
+    Unlike playerStandings, the standings are never all in memory at once:
+    PostgreSQL sessions read them through a server-side cursor, itersize
+    rows at a time. The session is tied up until the generator finishes or
+    is closed.
+
+    Args:
+      tournId: the tournament to get standings for.
+      session: the storage to use, defaults to getSession().
+      itersize: the number of rows fetched from the database at a time.
+
+    Yields:
+      Plain (id, name, wins, matches) tuples, as in playerStandings.
+    """
+    return _storage(session).iterStandings(tournId, itersize)
 
-    sql = '''
-        SELECT id, name, wins, matches_played
-        FROM standings
-        WHERE tourn=%s;
-    '''
-    conn = connect()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
-    cur.execute(sql, (tournId,))
-    results = cur.fetchall()
-    conn.close()
-    return results
 
+def exportStandings(tournId, out, format='csv', session=None, itersize=2000):
+    """Writes a tournament's standings to a file as they are read, see
+    iterStandings.
 
-def reportMatch(tourn, winner, loser=None):
+    Args:
+      tournId: the tournament to export.
+      out: a file open for writing native strings, such as open(path, 'w')
+        or, on Python 2, a cStringIO.StringIO.
+      format: 'csv' for CSV with a header row, or 'jsonl' for one JSON
+        object per line.
+      session: the storage to use, defaults to getSession().
+      itersize: the number of rows fetched from the database at a time.
+
+    Returns:
+      The number of players written.
+    """
+    columns = ('id', 'name', 'wins', 'matches_played')
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        write = writer.writerow
+    elif format == 'jsonl':
+        write = lambda row: out.write(
+            json.dumps(dict(zip(columns, row))) + '\n')
+    else:
+        raise ValueError('Unknown export format %r' % (format,))
+    count = 0
+    for row in iterStandings(tournId, session, itersize):
+        write(row)
+        count += 1
+    return count
+
+
+@metrics.timed('tournament.rebuildStandings')
+def rebuildStandings(tournId, session=None):
+    """Recomputes a tournament's standings from its recorded matches.
+
+    Standings are normally kept up to date by database triggers, this is only
+    needed after matches have been loaded with the triggers bypassed.
+
+    Args:
+      tournId: the tournament to rebuild standings for.
+      session: the storage to use, defaults to getSession().
+    """
+    storage = _storage(session)
+    storage.rebuildStandings(tournId)
+    _invalidate(storage, tournId)
+
+
+@metrics.timed('tournament.reportMatch')
+def reportMatch(tourn, winner, loser=None, session=None):
     """Records the outcome of a single match between two players.
 
     Args:
       winner:  the id number of the player who won
       loser:  the id number of the player who lost, if not passed will be
         null, representing a bye
+      session: the storage to use, defaults to getSession().
     """
+    storage = _storage(session)
+    generations = _generations(storage, tourn)
+    storage.reportMatch(tourn, winner, loser)
+    _invalidate(storage, tourn, [(winner, loser)], generations)
 
-    sql = '''
-        INSERT INTO matches (tourn, player0, player1, winner)
-        VALUES (%s, %s, %s, %s);
-    '''
 
-    player0, player1 = max(winner, loser), min(winner, loser)
+@metrics.timed('tournament.reportMatches')
+def reportMatches(tourn, results, session=None):
+    """Records the outcomes of many matches in a single transaction.
+
+    All results are checked against the tournament's players and match
+    history before anything is written, so either every result is recorded
+    or none are.
+
+    Args:
+      tourn: the tournament the matches were played in.
+      results: an iterable of (winner, loser) pairs, where loser is None for
+        a bye.
+      session: the storage to use, defaults to getSession().
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tourn, player0, player1, winner))
-    conn.commit()
-    conn.close()
+    Raises:
+      MatchReportError: if any result is invalid, listing every bad result.
+    """
+    storage = _storage(session)
+    results = list(results)
+    generations = _generations(storage, tourn)
+    storage.reportMatches(tourn, results)
+    _invalidate(storage, tourn, results, generations)
 
 
-def swissPairings(tournId):
+@metrics.timed('tournament.swissPairings')
+def swissPairings(tournId, session=None, rng=None, maxBracketGap=None,
+                  topOpponents=None, strategy='global', executor=None,
+                  useCache=True, serverEdges=False):
     """Returns a list of pairs of players for the next round of a match.
 
     Each player is paired with another player with an equal or nearly-equal
@@ -244,6 +429,35 @@ def swissPairings(tournId):
     https://www.leaguevine.com/blog/18/swiss-tournament-scheduling-leaguevines-new-algorithm/
     NOTE: This algorithm is O(n^3)
 
+    Args:
+      tournId: the tournament to pair.
+      session: the storage to use, defaults to getSession().
+      rng: object with a choice method used to pick the bye player, such as
+        a seeded random.Random for reproducible pairings. Defaults to the
+        random module.
+      maxBracketGap, topOpponents: prune the graph before matching, see
+        pruneEdges. The pruned graph's pairings are only used when they are
+        provably as good as the full graph's, otherwise the full graph is
+        matched instead.
+      strategy: 'global' to match the whole field at once, or 'groups' to
+        match each score group separately (see matchScoreGroups), falling
+        back to 'global' if some group cannot be paired.
+      executor: with the 'groups' strategy, an optional
+        concurrent.futures executor to match the groups in parallel.
+      useCache: whether to reuse the pairings of an earlier call with the
+        same options, bye included, if the tournament has not changed since
+        (see pairingCache). Only changes made through this module are
+        seen.
+      serverEdges: whether to have the database build the pairing graph
+        (see tournament.sql's pairing_edges) instead of building it here
+        from the match history. This moves the rematch test and weighting
+        into the database but sends more rows, O(n^2) edges rather than
+        O(n * rounds) matches, so it is usually slower. Only the 'global'
+        strategy is supported. With maxBracketGap, the database prunes the
+        graph, and the full graph is only fetched if the pruned one cannot
+        pair every player, so the pairings may be less fair than with
+        client-side pruning.
+
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
@@ -251,55 +465,181 @@ def swissPairings(tournId):
         id2: the second player's unique id
         name2: the second player's name
     """
+    storage = _storage(session)
+    options = _pairingOptions(
+        maxBracketGap, topOpponents, strategy, serverEdges)
+    if useCache:
+        cached = pairingCache(storage).get(tournId, options)
+        if cached is not None:
+            metrics.increment('cache.pairings.hits')
+            return cached
+        metrics.increment('cache.pairings.misses')
+        # Taken before loading, so pairings made from a round that changes
+        # meanwhile are not cached.
+        generation = pairingCache(storage).generation(tournId)
+
+    if serverEdges and (strategy != 'global' or topOpponents is not None):
+        raise ValueError(
+            'serverEdges only supports the global strategy and maxBracketGap')
+    snapshot = _loadRound(tournId, storage)
+    if serverEdges:
+        pairings = _pairOnServer(snapshot, storage, rng, maxBracketGap)
+    else:
+        pairings = pairStandings(snapshot.standings, snapshot.played,
+                                 snapshot.eligible, rng, maxBracketGap,
+                                 topOpponents, strategy, executor)
+
+    if useCache:
+        pairingCache(storage).put(
+            tournId, snapshot.round, hash(snapshot.played), options,
+            pairings, generation)
+    return pairings
+
+
+def _pairingOptions(maxBracketGap, topOpponents, strategy, serverEdges=False):
+    """Returns the options pairings depend on, as part of their pairingCache
+    key."""
+    return (maxBracketGap, topOpponents, strategy, serverEdges)
+
+
+def _pairOnServer(snapshot, storage, rng, maxBracketGap):
+    """Pairs a round from edges built by the storage, see swissPairings.
+
+    Raises:
+      RuntimeError: if the edges name players the snapshot lacks, because
+        the tournament changed after it was loaded.
+    """
+    standings = list(snapshot.standings)
+    pairings = _pairBye(standings, snapshot.eligible, rng)
+    excluded = pairings[0][0] if pairings else None
+    index = dict((player.id, i) for (i, player) in enumerate(standings))
+
+    def edgesWithin(gap):
+        edges = storage.pairingEdges(snapshot.tournId, excluded, gap)
+        if [a for (a, b, weight) in edges if a not in index or b not in index]:
+            raise RuntimeError(
+                'Tournament changed while pairing, call swissPairings again')
+        return sorted(
+            (min(index[a], index[b]), max(index[a], index[b]), weight)
+            for (a, b, weight) in edges)
+
+    edges = edgesWithin(maxBracketGap)
+    matches_list = _auditedMatching(edges)
+    if maxBracketGap is not None and (
+            len(matches_list) != len(standings) or -1 in matches_list):
+        edges = edgesWithin(None)
+        matches_list = _auditedMatching(edges)
+    pairings.extend(_pairsFromMates(standings, matches_list))
+    return pairings
+
+
+@metrics.timed('tournament.roundSnapshot')
+def roundSnapshot(tournId, session=None):
+    """Returns everything pairing a tournament's next round needs.
+
+    The standings, played pairs and bye history are read in a single query,
+    so the pairing engine can work from the snapshot without going back to
+    the database.
+
+    Args:
+      tournId: the tournament.
+      session: the storage to use, defaults to getSession().
+
+    Returns:
+      A RoundSnapshot (tournId, round, complete, standings, played,
+      eligible), see storage.RoundSnapshot.
+    """
+    return _storage(session).roundSnapshot(tournId)
 
+
+def _loadRound(tournId, storage):
+    """Returns the RoundSnapshot to pair a tournament's next round from.
+
+    Raises:
+      RuntimeError: if the current round is not complete.
+    """
+    snapshot = roundSnapshot(tournId, storage)
     # Check round is complete
-    if not roundComplete(tournId):
+    if not snapshot.complete:
         raise RuntimeError(
             'Round not complete, complete it before calling swissPairings'
         )
-    standings = playerStandings(tournId)
+    return snapshot
+
+
+@metrics.timed('tournament.pairStandings')
+def pairStandings(standings, played, eligible=None, rng=None,
+                  maxBracketGap=None, topOpponents=None, strategy='global',
+                  executor=None):
+    """Pairs a round from already loaded standings, see swissPairings.
+
+    This is the CPU-bound part of swissPairings, and needs no storage, so it
+    can be run in another thread or process.
+
+    Args:
+      standings: rows of (id, name, wins, matches_played), sorted by wins.
+      played: container of the pairKeys of pairs that have played.
+      eligible: container of the ids of players who may get a bye, only
+        needed if there is an odd number of players.
+      rng, maxBracketGap, topOpponents, strategy, executor: as for
+        swissPairings.
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples, as swissPairings returns.
+    """
+    standings = list(standings)
+    pairings = _pairBye(standings, eligible, rng)
+
+    if strategy == 'groups':
+        matches_list = matchScoreGroups(standings, played, executor)
+    elif strategy == 'global':
+        matches_list = None
+    else:
+        raise ValueError('Unknown pairing strategy %r' % (strategy,))
+
+    if matches_list is None:
+        matches_list = _matchRound(
+            standings, played, maxBracketGap, topOpponents)
+    pairings.extend(_pairsFromMates(standings, matches_list))
+    return pairings
+
+
+def _pairBye(standings, eligible, rng):
+    """Gives one player a bye if there is an odd number of players.
+
+    The bye player is removed from standings, a list.
+
+    Returns:
+      A list of the bye pairing (id, name, None, None), or an empty list.
+    """
     pairings = []
 
     # Give one player bye if neccesary.
     if len(standings) % 2 != 0:
-        players = set(standings)
-        while players:
-            # Randomly select player for bye.
-            player = random.sample(players, 1)[0]
-            if not hadBye(tournId, player.id):
-                byePlayer = player
-                break
-            else:
-                # Player has already had bye, try again.
-                players.remove(player)
-        else:
+        # Sort candidates so a seeded rng always picks the same player.
+        candidates = sorted(
+            (player for player in standings if player.id in eligible),
+            key=lambda player: player.id
+        )
+        if not candidates:
             # For some all players have had bye, should never happen!
             raise RuntimeError('Could not find player who has not had bye')
+        # Randomly select player for bye.
+        byePlayer = (rng or random).choice(candidates)
 
         # Remove the bye player from standings list
         standings.pop(standings.index(byePlayer))
-        pairings.append([byePlayer.id, byePlayer.name, None, None])
+        pairings.append((byePlayer.id, byePlayer.name, None, None))
+    return pairings
 
 
-    # Generate edges
-    edges = []
-    # Iterate of all possible matchups, to build edges in graph.
-    for i in range(len(standings)):
-        for j in range(i + 1, len(standings)):
-            player = standings[i]
-            opponent = standings[j]
-            if not haveAlreadyPlayed(tournId, player.id, opponent.id):
-                # Using maximum weighted pairings algorithm,
-                # weight = matches_played - difference_in_wins, for fairest matches.
-                difference_in_wins = abs(player.wins - opponent.wins)
-                weight = player.matches_played - difference_in_wins
-                edges.append((i, j, weight))
-
+def _pairsFromMates(standings, matches_list):
+    """Returns the (id1, name1, id2, name2) pairs of a mate list."""
     # Algorithm returns results as list, where the each value represents
     # the opponent of each index, eg.
     # [2, 3, 0, 1] mean player 0 plays player 2 and player 1 plays player 3.
     # Now convert this list into list of pairings.
-    matches_list = maxWeightMatching(edges, maxcardinality=True)
+    pairings = []
     for player_idx, opponent_idx in enumerate(matches_list):
         if player_idx > opponent_idx:
             # Pair will have been created in previous iteration.
@@ -309,85 +649,385 @@ def swissPairings(tournId):
     return pairings
 
 
-def roundComplete(tourn):
-    """Returns whether all players have played the same number of games.
+@metrics.timed('tournament.pairingEdges')
+def pairingEdges(standings, played, useNumpy=None):
+    """Returns the weighted edges of the pairing graph for maxWeightMatching.
+
+    There is an edge between every two players who have not played each
+    other, with weight matches_played - difference_in_wins, so the fairest
+    matches weigh the most.
+
+    Args:
+      standings: rows of (id, name, wins, matches_played), the graph's
+        vertices in order.
+      played: container of the pairKeys of pairs that have played.
+      useNumpy: whether to build the edges with NumPy, defaults to whenever
+        NumPy is installed.
 
     Returns:
-        boolean: Is the round complete?
+      A list of (i, j, weight) tuples, i < j being indexes into standings.
     """
+    if useNumpy is None:
+        useNumpy = numpy is not None
+    if useNumpy:
+        edges = _pairingEdgesNumpy(standings, played)
+        metrics.increment('pairing.edges', len(edges))
+        return edges
 
-    sql = '''
-        SELECT (
-            SELECT max(matches_played) from standings
-            WHERE tourn = %s
-        ) = ALL (
-            SELECT matches_played FROM standings
-            WHERE tourn = %s
-        );
-    '''
+    edges = []
+    # Iterate of all possible matchups, to build edges in graph.
+    for i in range(len(standings)):
+        player = standings[i]
+        for j in range(i + 1, len(standings)):
+            opponent = standings[j]
+            if pairKey(player.id, opponent.id) not in played:
+                # Using maximum weighted pairings algorithm,
+                # weight = matches_played - difference_in_wins, for fairest matches.
+                difference_in_wins = abs(player.wins - opponent.wins)
+                weight = player.matches_played - difference_in_wins
+                edges.append((i, j, weight))
+    metrics.increment('pairing.edges', len(edges))
+    return edges
+
+
+def _pairingEdgesNumpy(standings, played):
+    """pairingEdges, with the rematch test and weights computed as arrays."""
+    n = len(standings)
+    ids = numpy.fromiter((player.id for player in standings), numpy.int64, n)
+    wins = numpy.fromiter(
+        (player.wins for player in standings), numpy.int64, n)
+    matchesPlayed = numpy.fromiter(
+        (player.matches_played for player in standings), numpy.int64, n)
+
+    # allowed[i, j] is true when i < j and the players have not played.
+    allowed = numpy.triu(numpy.ones((n, n), dtype=bool), 1)
+    if played and n:
+        keys = numpy.fromiter(played, numpy.int64, len(played))
+        # Map both halves of each pairKey to standings indexes, dropping
+        # pairs with a player who is not in the standings (e.g. the bye).
+        order = numpy.argsort(ids)
+        sortedIds = ids[order]
+        pairIdx = []
+        for half in (keys >> 32, keys & 0xffffffff):
+            pos = numpy.minimum(numpy.searchsorted(sortedIds, half), n - 1)
+            pairIdx.append((order[pos], sortedIds[pos] == half))
+        (a, aFound), (b, bFound) = pairIdx
+        found = aFound & bFound
+        a, b = a[found], b[found]
+        allowed[numpy.minimum(a, b), numpy.maximum(a, b)] = False
+
+    i, j = numpy.nonzero(allowed)
+    weights = matchesPlayed[i] - numpy.abs(wins[i] - wins[j])
+    return list(zip(i.tolist(), j.tolist(), weights.tolist()))
+
+
+@metrics.timed('tournament.pruneEdges')
+def pruneEdges(edges, standings, maxBracketGap=None, topOpponents=None):
+    """Splits the pairing graph into candidate edges worth matching on and the
+    rest, since good Swiss pairings lie within nearby score brackets.
+    candidateEdges builds the kept edges without the rest of the graph.
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tourn, tourn))
-    result = cur.fetchall()[0][0]
-    conn.close()
-    return result
+    Args:
+      edges: (i, j, weight) edges from pairingEdges.
+      standings: the rows the edges index into.
+      maxBracketGap: if given, keep edges between players whose score
+        brackets (distinct win counts, in order) are at most this far apart.
+      topOpponents: if given, also keep each player's this many heaviest
+        edges, so players far from their bracket still have opponents.
 
+    Returns:
+      A tuple (kept, dropped) of lists of edges.
+    """
+    keep = set()
+    if maxBracketGap is not None:
+        scores = sorted(set(player.wins for player in standings))
+        bracket = dict((wins, b) for (b, wins) in enumerate(scores))
+        brackets = [bracket[player.wins] for player in standings]
+        for k, (i, j, weight) in enumerate(edges):
+            if abs(brackets[i] - brackets[j]) <= maxBracketGap:
+                keep.add(k)
+    if topOpponents is not None:
+        incident = [[] for _ in standings]
+        for k, (i, j, weight) in enumerate(edges):
+            incident[i].append(k)
+            incident[j].append(k)
+        for ks in incident:
+            ks.sort(key=lambda k: -edges[k][2])
+            keep.update(ks[:topOpponents])
+    kept, dropped = [], []
+    for k, edge in enumerate(edges):
+        (kept if k in keep else dropped).append(edge)
+    return kept, dropped
+
+
+@metrics.timed('tournament.candidateEdges')
+def candidateEdges(standings, played, maxBracketGap=None, topOpponents=None):
+    """Returns the edges pruneEdges keeps of the pairing graph, building
+    only those rather than the whole graph.
+
+    Args:
+      standings: rows of (id, name, wins, matches_played), the graph's
+        vertices in order.
+      played: container of the pairKeys of pairs that have played.
+      maxBracketGap, topOpponents: as for pruneEdges.
+
+    Returns:
+      A list of (i, j, weight) tuples, i < j, in the order pairingEdges
+      gives them.
+    """
+    groups = _scoreGroups(standings)
+    scores = sorted(groups)
+    bracket = dict((wins, b) for (b, wins) in enumerate(scores))
+    mostPlayed = max([player.matches_played for player in standings] + [0])
+    ids = [player.id for player in standings]
+
+    # later[i] lists the kept j > i, so edges come out in pairingEdges' order.
+    later = [[] for _ in standings]
+    if maxBracketGap is not None:
+        for i, player in enumerate(standings):
+            b = bracket[player.wins]
+            near = scores[max(0, b - maxBracketGap):b + maxBracketGap + 1]
+            for wins in near:
+                later[i].extend(j for j in groups[wins] if j > i and
+                                pairKey(ids[i], ids[j]) not in played)
+    if topOpponents is not None:
+        for i, player in enumerate(standings):
+            # Visit score groups by difference in wins, which bounds the
+            # weight of their edges, until no closer edge can be found.
+            found = []
+            for wins in sorted(scores, key=lambda w: abs(w - player.wins)):
+                if (len(found) >= topOpponents and -found[topOpponents - 1][0]
+                        > mostPlayed - abs(wins - player.wins)):
+                    break
+                found.extend(
+                    (abs(wins - player.wins) -
+                     standings[min(i, j)].matches_played, j)
+                    for j in groups[wins]
+                    if j != i and pairKey(ids[i], ids[j]) not in played)
+                found.sort()
+            for (w, j) in found[:topOpponents]:
+                later[min(i, j)].append(max(i, j))
 
-def haveAlreadyPlayed(tourn, playerA, playerB):
+    edges = []
+    for i, player in enumerate(standings):
+        js = later[i]
+        if topOpponents is not None:
+            js = set(js)
+        edges.extend((i, j, player.matches_played - abs(player.wins -
+                                                         standings[j].wins))
+                     for j in sorted(js))
+    metrics.increment('pairing.edges', len(edges))
+    return edges
+
+
+def _scoreGroups(standings):
+    """Returns a dict of each win count to the ascending standings indexes
+    of the players with it."""
+    groups = {}
+    for i, player in enumerate(standings):
+        groups.setdefault(player.wins, []).append(i)
+    return groups
+
+
+def _coversGraph(dual, standings, played, kept):
+    """Returns whether no edge of the pairing graph outside kept has negative
+    slack under dual, so a perfect matching dual certifies on kept is
+    optimal for the whole graph too.
+
+    Every edge between two score groups weighs at most the most matches
+    played less their difference in wins, so a pair of groups whose least
+    vertex duals cover that needs no edge checked one by one.
+    """
+    groups = _scoreGroups(standings)
+    least = dict((wins, min(dual.vertex[i] for i in group))
+                 for (wins, group) in groups.items())
+    mostPlayed = max(player.matches_played for player in standings)
+    kept = set((i, j) for (i, j, weight) in kept)
+    for a in groups:
+        for b in groups:
+            if b > a or least[a] + least[b] >= 2 * (mostPlayed - (a - b)):
+                continue
+            for i in groups[a]:
+                for j in groups[b]:
+                    (x, y) = (min(i, j), max(i, j))
+                    if (a == b and i >= j or (x, y) in kept or
+                            pairKey(standings[x].id, standings[y].id)
+                            in played):
+                        continue
+                    if edgeSlack(dual, x, y, standings[x].matches_played -
+                                 (a - b)) < 0:
+                        return False
+    return True
+
+
+@metrics.timed('tournament.matching')
+def _matchRound(standings, played, maxBracketGap, topOpponents):
+    """Returns maxWeightMatching's mate list for a round's pairing graph.
+
+    When pruning is asked for, only the candidate edges are built and
+    matched first. Their matching is kept if it pairs every player and the
+    dual solution certifying it also covers every edge left out, in which
+    case no such edge could improve it and it is as good as matching the
+    full graph. Otherwise the full graph is built and matched.
+    """
+    if maxBracketGap is not None or topOpponents is not None:
+        kept = candidateEdges(standings, played, maxBracketGap, topOpponents)
+        if kept:
+            mate, dual = maxWeightMatching(
+                kept, maxcardinality=True, returndual=True)
+            if (len(mate) == len(standings) and -1 not in mate and
+                    _coversGraph(dual, standings, played, kept)):
+                return mate
+    return _auditedMatching(pairingEdges(standings, played))
+
+
+def _auditedMatching(edges):
+    """maxWeightMatching with maxcardinality, auditing AUDIT_RATE of calls.
+
+    Raises:
+      RuntimeError: if an audited matching is not certified optimal.
+    """
+    if not AUDIT_RATE or random.random() >= AUDIT_RATE:
+        return maxWeightMatching(edges, maxcardinality=True)
+    mate, dual = maxWeightMatching(edges, maxcardinality=True, returndual=True)
+    if not checkMatching(edges, mate, dual, maxcardinality=True):
+        raise RuntimeError('Pairing failed its optimality audit')
+    return mate
+
+
+@metrics.timed('tournament.matchScoreGroups')
+def matchScoreGroups(standings, played, executor=None):
+    """Pairs each score group on its own, in place of one global matching.
+
+    Players are grouped by wins. Working down from the top group, a group
+    with an odd number of players sends its last player down to the next
+    group as a floater, so every group can be paired internally. Each group
+    is then matched with maxWeightMatching, which costs far less than
+    matching the whole field, and the groups are independent so they can be
+    matched in parallel.
+
+    Args:
+      standings: rows of (id, name, wins, matches_played), sorted by wins,
+        with an even number of players.
+      played: container of the pairKeys of pairs that have played.
+      executor: an optional concurrent.futures executor (or anything with a
+        compatible map method) to match the groups with.
+
+    Returns:
+      A mate list like maxWeightMatching's, indexing into standings, or None
+      if some group has no pairing without rematches.
+    """
+    groups = []
+    byWins = {}
+    for i, player in enumerate(standings):
+        byWins.setdefault(player.wins, []).append(i)
+    floater = None
+    for wins in sorted(byWins, reverse=True):
+        group = byWins[wins]
+        if floater is not None:
+            group.insert(0, floater)
+        floater = group.pop() if len(group) % 2 else None
+        if group:
+            groups.append(group)
+    if floater is not None:
+        return None
+
+    groupEdges = [pairingEdges([standings[i] for i in group], played)
+                  for group in groups]
+    mates = (executor.map if executor else map)(_matchGroup, groupEdges)
+
+    matches_list = [-1] * len(standings)
+    for group, mate in zip(groups, mates):
+        if len(mate) != len(group) or -1 in mate:
+            return None
+        for local, opponent in enumerate(mate):
+            matches_list[group[local]] = group[opponent]
+    return matches_list
+
+
+@metrics.timed('tournament.matchGroup')
+def _matchGroup(edges):
+    """Matches one score group's edges, see matchScoreGroups."""
+    return maxWeightMatching(edges, maxcardinality=True)
+
+
+@metrics.timed('tournament.roundComplete')
+def roundComplete(tourn, session=None, useCache=True):
+    """Returns whether all players have played the same number of games.
+
+    Args:
+        tourn: tournament id
+        session: the storage to use, defaults to getSession()
+        useCache: whether to use the session's standingsCache
+
+    Returns:
+        boolean: Is the round complete?
+    """
+    storage = _storage(session)
+    if useCache:
+        return standingsCache(storage).roundComplete(
+            tourn, lambda: storage.playerStandings(tourn))
+    return storage.roundComplete(tourn)
+
+
+@metrics.timed('tournament.haveAlreadyPlayed')
+def haveAlreadyPlayed(tourn, playerA, playerB, session=None):
     """Returns whether two players have already played.
 
     Args:
         tourn: tournament id
         playerA: id of player
         playerB: id of other player
+        session: the storage to use, defaults to getSession()
 
     Returns:
         boolean: Have players played already?
     """
-    sql = """
-        SELECT EXISTS (
-            SELECT *
-            FROM matches
-            WHERE tourn = %s
-            AND player0 = %s
-            AND player1 = %s
-        );
+    return _storage(session).haveAlreadyPlayed(tourn, playerA, playerB)
+
+
+@metrics.timed('tournament.playedPairs')
+def playedPairs(tourn, session=None):
+    """Returns every pair of players that have already played each other.
+
+    Loads the whole tournament's history in one query, so pairing code can
+    check for rematches in memory rather than calling haveAlreadyPlayed for
+    each candidate pair.
+
+    Args:
+        tourn: tournament id
+        session: the storage to use, defaults to getSession()
+
+    Returns:
+        set: the pairKey of each pair that has played.
     """
+    return _storage(session).playedPairs(tourn)
 
-    player0, player1 = max(playerA, playerB), min(playerA, playerB)
 
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tourn, player0, player1))
-    result = cur.fetchall()[0][0]
-    conn.close()
-    return result
+@metrics.timed('tournament.byeEligible')
+def byeEligible(tourn, session=None):
+    """Returns the players in a tournament who have not yet had a bye.
+
+    Args:
+        tourn: tournament id
+        session: the storage to use, defaults to getSession()
+
+    Returns:
+        set: ids of the players still eligible for a bye.
+    """
+    return _storage(session).byeEligible(tourn)
 
 
-def hadBye(tourn, player):
+@metrics.timed('tournament.hadBye')
+def hadBye(tourn, player, session=None):
     """Returns whether player has already had a bye.
 
     Args:
         tourn: tournament id
         player: id of player
+        session: the storage to use, defaults to getSession()
 
     Returns:
         boolean: Has player already had a bye?
     """
-    sql = """
-        SELECT EXISTS (
-            SELECT *
-            FROM matches
-            WHERE tourn = %s
-            AND player0 = %s
-            AND player1 IS NULL
-        );
-    """
-
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute(sql, (tourn, player))
-    result = cur.fetchall()[0][0]
-    conn.close()
-    return result
+    return _storage(session).hadBye(tourn, player)
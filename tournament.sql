@@ -39,20 +39,138 @@ CREATE TABLE matches (
     CHECK (winner = player0 or winner = player1)
 );
 
+-- UNIQUE (tourn, player0, player1) serves lookups by player0; these serve
+-- lookups by player1 and of byes (hadBye, byeEligible).
+CREATE INDEX matches_player1 ON matches (tourn, player1);
+CREATE INDEX matches_byes ON matches (tourn, player0) WHERE player1 IS NULL;
 
--- Represents current standings.
+
+-- Each match once for each player in it. The two halves of the union each
+-- filter on an indexed column, where a join on player0 OR player1 cannot.
+CREATE VIEW match_players AS
+SELECT tourn, player0 AS player, winner
+FROM matches
+UNION ALL
+SELECT tourn, player1 AS player, winner
+FROM matches
+WHERE player1 IS NOT NULL;
+
+
+-- Records each tournament player's running totals. Rows are kept up to date
+-- by the triggers below, so reading standings is an index range scan rather
+-- than an aggregate over all matches.
+CREATE TABLE player_standings (
+    tourn           integer NOT NULL,
+    player          integer NOT NULL,
+    wins            integer NOT NULL DEFAULT 0,
+    matches_played  integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (tourn, player),
+    FOREIGN KEY (tourn, player) REFERENCES tournament_players (tourn, player)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX player_standings_rank
+ON player_standings (tourn, wins DESC, player);
+
+CREATE INDEX player_standings_played
+ON player_standings (tourn, matches_played);
+
+
+-- Gives each player entered in a tournament an empty standings row.
+CREATE FUNCTION add_player_standing() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO player_standings (tourn, player)
+    VALUES (NEW.tourn, NEW.player);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournament_players_standing
+AFTER INSERT ON tournament_players
+FOR EACH ROW EXECUTE PROCEDURE add_player_standing();
+
+
+-- Applies each recorded, changed or removed match to both players' totals.
+CREATE FUNCTION update_player_standings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE player_standings
+        SET wins = wins - (player = OLD.winner)::integer,
+            matches_played = matches_played - 1
+        WHERE tourn = OLD.tourn
+        AND player IN (OLD.player0, OLD.player1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE player_standings
+        SET wins = wins + (player = NEW.winner)::integer,
+            matches_played = matches_played + 1
+        WHERE tourn = NEW.tourn
+        AND player IN (NEW.player0, NEW.player1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_standings
+AFTER INSERT OR UPDATE OR DELETE ON matches
+FOR EACH ROW EXECUTE PROCEDURE update_player_standings();
+
+
+-- Recomputes a tournament's standings from its matches, for repairing the
+-- table after the triggers have been bypassed (e.g. by a bulk COPY).
+CREATE FUNCTION rebuild_standings(t integer) RETURNS void AS $$
+    UPDATE player_standings
+    SET wins = totals.wins, matches_played = totals.matches_played
+    FROM (
+        SELECT
+            tournament_players.player,
+            count(CASE WHEN match_players.player = winner THEN 1 END) AS wins,
+            count(match_players.player) AS matches_played
+        FROM tournament_players LEFT JOIN match_players
+        ON match_players.tourn = tournament_players.tourn
+        AND match_players.player = tournament_players.player
+        WHERE tournament_players.tourn = t
+        GROUP BY tournament_players.player
+    ) AS totals
+    WHERE player_standings.tourn = t
+    AND player_standings.player = totals.player;
+$$ LANGUAGE sql;
+
+
+-- Represents current standings. Ordered by player_standings' own columns,
+-- so the player_standings_rank index can supply the order.
 CREATE VIEW standings AS
 SELECT id, name, wins, matches_played, tourn
-FROM players JOIN (
-    SELECT
-        tournament_players.player,
-        count(CASE WHEN tournament_players.player = matches.winner then 1 END) AS wins,
-        count(matches.id) AS matches_played,
-        tournament_players.tourn
-    FROM tournament_players LEFT JOIN matches
-    ON tournament_players.player = matches.player0
-    OR tournament_players.player = matches.player1
-    GROUP BY tournament_players.tourn, tournament_players.player
-) AS id_standings
-ON players.id = id_standings.player
-ORDER BY wins DESC, tourn;
+FROM player_standings JOIN players
+ON players.id = player_standings.player
+ORDER BY tourn, wins DESC, player_standings.player;
+
+
+-- The edges of the graph swissPairings matches to pair tournament t's next
+-- round: every two players who have not played each other, weighted
+-- matches_played - difference in wins. Player excluded (the bye) is left out,
+-- and if max_gap is given so are pairs whose score brackets (distinct win
+-- counts, in order) are more than max_gap apart. The graph has O(n^2) edges,
+-- more rows than the match history it replaces.
+CREATE FUNCTION pairing_edges(t integer, excluded integer DEFAULT NULL,
+                              max_gap integer DEFAULT NULL)
+RETURNS TABLE (player_a integer, player_b integer, weight integer) AS $$
+    WITH ranked AS (
+        SELECT player, wins, matches_played,
+               dense_rank() OVER (ORDER BY wins DESC) AS bracket
+        FROM player_standings
+        WHERE tourn = t
+        AND player IS DISTINCT FROM excluded
+    )
+    SELECT a.player, b.player, a.matches_played - abs(a.wins - b.wins)
+    FROM ranked AS a JOIN ranked AS b
+    ON a.player > b.player
+    WHERE (max_gap IS NULL OR abs(a.bracket - b.bracket) <= max_gap)
+    AND NOT EXISTS (
+        SELECT *
+        FROM matches
+        WHERE matches.tourn = t
+        AND matches.player0 = a.player
+        AND matches.player1 = b.player
+    );
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio API for the Swiss-system tournament
+#
+# The public functions of tournament.py as coroutines, on a pool of asyncpg
+# connections, so a web front end serving many tournaments does not tie up a
+# thread per request. Pairing is CPU-bound and runs in an executor, so it
+# does not stall the event loop. Requires Python 3.7 and asyncpg.
+#
+
+import asyncio
+import contextlib
+import functools
+import itertools
+
+import asyncpg
+
+from storage import (Standing, _checkResults, _matchRow, _roundSnapshot,
+                     pairKey)
+from tournament import pairStandings
+
+
+DSN = "postgresql:///tournament"
+
+
+class AsyncSession(object):
+    """A pool of asyncpg connections to the tournament database.
+
+    The pool is opened on first use, inside the running event loop.
+
+    Args:
+      dsn: the database to connect to, as a libpq connection URI.
+      minSize: the number of connections kept open even when idle.
+      maxSize: the most connections open at once; callers beyond this wait
+        for a connection to be returned.
+      idleTimeout: seconds after which an idle connection beyond minSize is
+        closed.
+      executor: the concurrent.futures executor swissPairings matches in,
+        defaults to the event loop's default executor. A ProcessPoolExecutor
+        keeps the matching from competing with the loop for the GIL.
+    """
+
+    def __init__(self, dsn=DSN, minSize=1, maxSize=10, idleTimeout=300,
+                 executor=None):
+        self.dsn = dsn
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.executor = executor
+        self.closed = False
+        self._pool = None
+        self._opening = None
+
+    async def _getPool(self):
+        if self._pool is None:
+            # Every caller waits on the same task, so one pool is created.
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(asyncpg.create_pool(
+                    self.dsn, min_size=self.minSize, max_size=self.maxSize,
+                    max_inactive_connection_lifetime=self.idleTimeout))
+            self._pool = await self._opening
+        return self._pool
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, **options):
+        """Yields a pooled connection inside a transaction, which commits if
+        the block succeeds and rolls back if it raises. Options are passed
+        to asyncpg's Connection.transaction()."""
+        pool = await self._getPool()
+        async with pool.acquire() as conn:
+            async with conn.transaction(**options):
+                yield conn
+
+    async def close(self):
+        """Closes every pooled connection."""
+        self.closed = True
+        if self._pool is not None:
+            await self._pool.close()
+
+
+_defaultSession = None
+
+
+def getSession():
+    """Returns the default session, creating it on first use."""
+    global _defaultSession
+    if _defaultSession is None or _defaultSession.closed:
+        _defaultSession = AsyncSession()
+    return _defaultSession
+
+
+def setSession(session):
+    """Replaces the default session used when no session is passed.
+
+    Args:
+      session: an AsyncSession, or None to create a fresh one on next use.
+    """
+    global _defaultSession
+    _defaultSession = session
+
+
+def _session(session):
+    """Returns session, or the default session if it is None."""
+    if session is None:
+        return getSession()
+    return session
+
+
+async def _execute(session, sql, *args):
+    async with _session(session).transaction() as conn:
+        await conn.execute(sql, *args)
+
+
+async def _fetchval(session, sql, *args):
+    async with _session(session).transaction() as conn:
+        return await conn.fetchval(sql, *args)
+
+
+async def deleteMatches(session=None):
+    """Remove all the match records from the database."""
+    await _execute(session, 'DELETE FROM matches;')
+
+
+async def deletePlayers(session=None):
+    """Remove all the player records from the database."""
+    await _execute(session, 'DELETE FROM players;')
+
+
+async def deleteTournaments(session=None):
+    """Remove all the tournament records from the database."""
+    await _execute(session, 'DELETE FROM tournaments;')
+
+
+async def deleteTournamentPlayers(session=None):
+    """Remove all the records from the tournament_players table."""
+    await _execute(session, 'DELETE FROM tournament_players;')
+
+
+async def countPlayers(session=None):
+    """Returns the number of players currently registered."""
+    return await _fetchval(session, 'SELECT count(*) FROM players;')
+
+
+async def countTournamentPlayers(tournId, session=None):
+    """Returns the number of players currently registered for tournament,
+    see tournament.countTournamentPlayers."""
+    sql = '''
+        SELECT count(*)
+        FROM tournament_players
+        WHERE tourn = $1;
+    '''
+    return await _fetchval(session, sql, tournId)
+
+
+async def registerTournament(name, session=None):
+    """Adds a tournament and returns its id, see
+    tournament.registerTournament."""
+    sql = '''
+        INSERT INTO tournaments (name) VALUES ($1)
+        RETURNING id;
+    '''
+    return await _fetchval(session, sql, name)
+
+
+async def registerPlayer(name, session=None):
+    """Adds a player and returns their id, see tournament.registerPlayer."""
+    sql = '''
+        INSERT INTO players (name) VALUES ($1)
+        RETURNING id;
+    '''
+    return await _fetchval(session, sql, name)
+
+
+async def registerPlayerForTournament(tournId, playerId, session=None):
+    """Adds a player to a tournament."""
+    sql = '''
+        INSERT INTO tournament_players (tourn, player)
+        VALUES ($1, $2);
+    '''
+    await _execute(session, sql, tournId, playerId)
+
+
+_insertTournamentPlayersSql = '''
+    INSERT INTO tournament_players (tourn, player)
+    SELECT $1, unnest($2::integer[]);
+'''
+
+
+async def registerPlayers(names, tournId=None, session=None, batchSize=1000):
+    """Adds many players in one transaction, and optionally enters them in a
+    tournament, see tournament.registerPlayers.
+
+    Returns:
+      A list of the players' new ids, in the same order as names.
+    """
+    sql = '''
+        INSERT INTO players (name)
+        SELECT unnest($1::text[])
+        RETURNING id;
+    '''
+    ids = []
+    names = iter(names)
+    async with _session(session).transaction() as conn:
+        while True:
+            batch = list(itertools.islice(names, batchSize))
+            if not batch:
+                break
+            # Serial ids are drawn in row order within one statement.
+            batchIds = sorted(id_ for (id_,) in await conn.fetch(sql, batch))
+            if tournId is not None:
+                await conn.execute(
+                    _insertTournamentPlayersSql, tournId, batchIds)
+            ids.extend(batchIds)
+    return ids
+
+
+async def registerPlayersForTournament(tournId, playerIds, session=None,
+                                       batchSize=1000):
+    """Adds many existing players to a tournament in one transaction."""
+    playerIds = iter(playerIds)
+    async with _session(session).transaction() as conn:
+        while True:
+            batch = list(itertools.islice(playerIds, batchSize))
+            if not batch:
+                break
+            await conn.execute(_insertTournamentPlayersSql, tournId, batch)
+
+
+_standingsSql = '''
+    SELECT id, name, wins, matches_played
+    FROM standings
+    WHERE tourn = $1;
+'''
+
+_roundCompleteSql = '''
+    SELECT coalesce(min(matches_played) = max(matches_played), true)
+    FROM player_standings
+    WHERE tourn = $1;
+'''
+
+_playedPairsSql = '''
+    SELECT player0, player1
+    FROM matches
+    WHERE tourn = $1
+    AND player1 IS NOT NULL;
+'''
+
+_byeEligibleSql = '''
+    SELECT player
+    FROM tournament_players
+    WHERE tourn = $1
+    AND NOT EXISTS (
+        SELECT *
+        FROM matches
+        WHERE matches.tourn = tournament_players.tourn
+        AND matches.player0 = tournament_players.player
+        AND matches.player1 IS NULL
+    );
+'''
+
+
+_roundSnapshotSql = '''
+    SELECT 0 AS kind, id, name, wins, matches_played
+    FROM standings
+    WHERE tourn = $1
+    UNION ALL
+    SELECT 1, player0, NULL, player1, NULL
+    FROM matches
+    WHERE tourn = $1;
+'''
+
+
+async def roundSnapshot(tournId, session=None):
+    """Returns everything pairing a tournament's next round needs, read in
+    one query, see tournament.roundSnapshot."""
+    async with _session(session).transaction() as conn:
+        return _roundSnapshot(
+            tournId, await conn.fetch(_roundSnapshotSql, tournId))
+
+
+async def playerStandings(tournId, session=None):
+    """Returns a list of Standing rows (id, name, wins, matches_played),
+    sorted by wins, see tournament.playerStandings."""
+    async with _session(session).transaction() as conn:
+        return [Standing(*row) for row in await conn.fetch(
+            _standingsSql, tournId)]
+
+
+async def rebuildStandings(tournId, session=None):
+    """Recomputes a tournament's standings from its recorded matches."""
+    await _execute(session, 'SELECT rebuild_standings($1);', tournId)
+
+
+_insertMatchesSql = '''
+    INSERT INTO matches (tourn, player0, player1, winner)
+    SELECT $1, player0, player1, winner
+    FROM unnest($2::integer[], $3::integer[], $4::integer[])
+        AS results (player0, player1, winner);
+'''
+
+
+async def reportMatch(tourn, winner, loser=None, session=None):
+    """Records the outcome of a single match between two players, loser None
+    for a bye."""
+    sql = '''
+        INSERT INTO matches (tourn, player0, player1, winner)
+        VALUES ($1, $2, $3, $4);
+    '''
+    await _execute(session, sql, *_matchRow(tourn, winner, loser))
+
+
+async def reportMatches(tourn, results, session=None):
+    """Records the outcomes of many matches in one transaction, after checking
+    every one, see tournament.reportMatches.
+
+    Raises:
+      MatchReportError: if any result is invalid, listing every bad result.
+    """
+    async with _session(session).transaction() as conn:
+        players = set(player for (player,) in await conn.fetch(
+            'SELECT player FROM tournament_players WHERE tourn = $1;', tourn))
+        played, byes = set(), set()
+        for player0, player1 in await conn.fetch(
+                'SELECT player0, player1 FROM matches WHERE tourn = $1;',
+                tourn):
+            if player1 is None:
+                byes.add(player0)
+            else:
+                played.add(pairKey(player0, player1))
+        results = _checkResults(results, players, played, byes)
+        if results:
+            rows = [_matchRow(tourn, winner, loser)[1:]
+                    for winner, loser in results]
+            await conn.execute(_insertMatchesSql, tourn, *map(list, zip(*rows)))
+
+
+async def swissPairings(tournId, session=None, rng=None, maxBracketGap=None,
+                        topOpponents=None, strategy='global', executor=None):
+    """Returns the pairs of players for the next round, see
+    tournament.swissPairings.
+
+    The standings and match history are read in one query, then matched by
+    tournament.pairStandings in an executor, so the event loop keeps serving
+    other requests meanwhile.
+
+    Args:
+      executor: the executor to match in, defaults to the session's.
+      The other arguments are as for tournament.swissPairings.
+    """
+    session = _session(session)
+    snapshot = await roundSnapshot(tournId, session)
+    if not snapshot.complete:
+        raise RuntimeError(
+            'Round not complete, complete it before calling swissPairings'
+        )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or session.executor,
+        functools.partial(pairStandings, snapshot.standings, snapshot.played,
+                          snapshot.eligible, rng, maxBracketGap, topOpponents,
+                          strategy))
+
+
+async def roundComplete(tourn, session=None):
+    """Returns whether all players have played the same number of games."""
+    return await _fetchval(session, _roundCompleteSql, tourn)
+
+
+async def haveAlreadyPlayed(tourn, playerA, playerB, session=None):
+    """Returns whether two players have already played."""
+    sql = '''
+        SELECT EXISTS (
+            SELECT *
+            FROM matches
+            WHERE tourn = $1
+            AND player0 = $2
+            AND player1 = $3
+        );
+    '''
+    return await _fetchval(session, sql, tourn, max(playerA, playerB),
+                           min(playerA, playerB))
+
+
+async def playedPairs(tourn, session=None):
+    """Returns the set of pairKeys of the pairs that have played."""
+    async with _session(session).transaction() as conn:
+        return set(pairKey(player0, player1) for player0, player1 in
+                   await conn.fetch(_playedPairsSql, tourn))
+
+
+async def byeEligible(tourn, session=None):
+    """Returns the set of ids of players who have not had a bye."""
+    async with _session(session).transaction() as conn:
+        return set(player for (player,) in await conn.fetch(
+            _byeEligibleSql, tourn))
+
+
+async def hadBye(tourn, player, session=None):
+    """Returns whether a player has had a bye."""
+    sql = '''
+        SELECT EXISTS (
+            SELECT *
+            FROM matches
+            WHERE tourn = $1
+            AND player0 = $2
+            AND player1 IS NULL
+        );
+    '''
+    return await _fetchval(session, sql, tourn, player)
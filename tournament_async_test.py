@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#
+# Test cases for tournament_async.py, which needs Python 3.7 or later and
+# asyncpg. They are kept apart from tournament_test.py, which also runs on
+# Python 2, and are skipped when asyncpg is not installed.
+#
+
+import asyncio
+import random
+import sys
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+def testAsyncApi():
+    """
+        Test the asyncio API runs an event like the blocking one.
+    """
+    import tournament_async as ta
+
+    async def event():
+        session = ta.AsyncSession()
+        try:
+            await ta.deleteMatches(session)
+            await ta.deleteTournamentPlayers(session)
+            await ta.deleteTournaments(session)
+            await ta.deletePlayers(session)
+            tournId = await ta.registerTournament('Async Tournament', session)
+            await ta.registerPlayers(
+                ['player %i' % i for i in range(5)], tournId, session)
+            pairs = await ta.swissPairings(tournId, session, random.Random(1))
+            await ta.reportMatches(
+                tournId, [(pair[0], pair[2]) for pair in pairs], session)
+            standings = await ta.playerStandings(tournId, session)
+            if len(pairs) != 3 or sum(row.wins for row in standings) != 3:
+                raise ValueError("Async event gave wrong pairings or wins.")
+            if not await ta.roundComplete(tournId, session):
+                raise ValueError("Async round should be complete.")
+        finally:
+            await session.close()
+
+    asyncio.run(event())
+    testSuccess("The asyncio API runs an event")
+
+
+TEST_COUNT = 0
+
+def testSuccess(msg):
+    global TEST_COUNT
+    TEST_COUNT += 1
+    print('%i. %s' % (TEST_COUNT, msg))
+
+
+if __name__ == '__main__':
+    if asyncpg is None:
+        print('asyncpg is not installed, skipping the asyncio tests.')
+        sys.exit(0)
+    testAsyncApi()
+    print('Success!  All tests pass!')
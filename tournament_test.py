@@ -6,6 +6,11 @@
 # If you do add any of the extra credit options, be sure to add/modify these test cases
 # as appropriate to account for your module's added functionality.
 
+import random
+import sqlite3
+import time
+
+import mwmatching
 from tournament import *
 
 def testCount():
@@ -359,6 +364,758 @@ def testAllowOddPlayers():
     testSuccess("A bye occured every round as expected.")
 
 
+def testPlayedPairs():
+    """
+        Test playedPairs returns every pair that has played, in either order,
+        and ignores byes.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Classic Tournament')
+    playerIds = [registerPlayer('player %i' % i) for i in range(3)]
+    for id_ in playerIds:
+        registerPlayerForTournament(tournId, id_)
+
+    if playedPairs(tournId):
+        raise ValueError("playedPairs should be empty before any matches.")
+    reportMatch(tournId, playerIds[0], playerIds[1])
+    reportMatch(tournId, playerIds[2])
+    played = playedPairs(tournId)
+    if played != set([pairKey(playerIds[1], playerIds[0])]):
+        raise ValueError(
+            "playedPairs returned %s, expected only the one match" % played)
+    testSuccess("playedPairs returned the played pair as expected")
+
+
+def testByeEligible():
+    """
+        Test byeEligible drops players once they have had a bye, and that a
+        seeded rng picks the same bye player every time.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Classic Tournament')
+    playerIds = [registerPlayer('player %i' % i) for i in range(3)]
+    for id_ in playerIds:
+        registerPlayerForTournament(tournId, id_)
+
+    if byeEligible(tournId) != set(playerIds):
+        raise ValueError("All players should be eligible for a bye at first.")
+    reportMatch(tournId, playerIds[0])
+    if byeEligible(tournId) != set(playerIds[1:]):
+        raise ValueError("A player who had a bye should not be eligible.")
+    testSuccess("byeEligible returned players without a bye as expected")
+
+    tournId = registerTournament('Seeded Tournament')
+    for id_ in playerIds:
+        registerPlayerForTournament(tournId, id_)
+    byes = set()
+    for _ in range(5):
+        pairs = swissPairings(tournId, rng=random.Random(42))
+        byes.update(pair[0] for pair in pairs if pair[2] is None)
+    if len(byes) != 1:
+        raise ValueError("Seeded rng should always give the same bye.")
+    testSuccess("Seeded rng gave a reproducible bye")
+
+
+def testReportMatchesInBulk():
+    """
+        Test reportMatches records a round in one go, and rejects a batch
+        with bad results without recording any of it.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Classic Tournament')
+    playerIds = [registerPlayer('player %i' % i) for i in range(5)]
+    for id_ in playerIds:
+        registerPlayerForTournament(tournId, id_)
+
+    reportMatches(tournId, [
+        (playerIds[0], playerIds[1]),
+        (playerIds[3], playerIds[2]),
+        (playerIds[4], None),
+    ])
+    standings = playerStandings(tournId)
+    for (i, n, w, m) in standings:
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if i in (playerIds[0], playerIds[3], playerIds[4]) and w != 1:
+            raise ValueError("Each winner should have one win recorded.")
+    testSuccess("reportMatches recorded every result")
+
+    try:
+        reportMatches(tournId, [
+            (playerIds[0], playerIds[2]),
+            (playerIds[1], playerIds[0]),
+            (playerIds[4], None),
+        ])
+    except MatchReportError as e:
+        if [index for (index, result, reason) in e.errors] != [1, 2]:
+            raise ValueError(
+                "reportMatches reported errors %s, expected rows 1 and 2" %
+                e.errors)
+    else:
+        raise ValueError("reportMatches should reject rematches and 2nd byes")
+    if haveAlreadyPlayed(tournId, playerIds[0], playerIds[2]):
+        raise ValueError("A rejected batch should not record any results.")
+    testSuccess("reportMatches rejected invalid results row by row")
+
+
+def testRegisterPlayersInBulk():
+    """
+        Test registerPlayers returns ids in input order and enters the players
+        in the tournament, streaming names from a CSV file.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Open Tournament')
+    names = ['player %i' % i for i in range(25)]
+    playerIds = registerPlayers(iter(names), tournId, batchSize=10)
+    if len(playerIds) != 25 or countTournamentPlayers(tournId) != 25:
+        raise ValueError("registerPlayers should register every player.")
+    standings = dict((row.id, row.name) for row in playerStandings(tournId))
+    if [standings[id_] for id_ in playerIds] != names:
+        raise ValueError("registerPlayers should return ids in input order.")
+    testSuccess("registerPlayers registered players in order")
+
+    otherTournId = registerTournament('Closed Tournament')
+    registerPlayersForTournament(otherTournId, playerIds[:5])
+    if countTournamentPlayers(otherTournId) != 5:
+        raise ValueError("registerPlayersForTournament should enter players.")
+    csvIds = registerPlayersFromCsv(
+        ['id,name\n', '1,Applejack\n', '2,Rarity\n'], otherTournId)
+    if countTournamentPlayers(otherTournId) != 7 or len(csvIds) != 2:
+        raise ValueError("registerPlayersFromCsv should enter each row.")
+    testSuccess("Players entered in bulk from ids and CSV rows")
+
+
+def testStandingsPerTournament():
+    """
+        Test standings only count matches from their own tournament when a
+        player is entered in more than one.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Grand Tournament')
+    otherTournId = registerTournament('Lesser Tournament')
+    playerIds = registerPlayers(['player 1', 'player 2'], tournId)
+    registerPlayersForTournament(otherTournId, playerIds)
+    reportMatch(tournId, playerIds[0], playerIds[1])
+
+    for (i, n, w, m) in playerStandings(otherTournId):
+        if m != 0 or w != 0:
+            raise ValueError(
+                "Matches in one tournament should not count in another.")
+    if playerStandings(tournId)[0][0] != playerIds[0]:
+        raise ValueError("The match winner should lead the standings.")
+    deleteMatches()
+    for (i, n, w, m) in playerStandings(tournId):
+        if m != 0 or w != 0:
+            raise ValueError("Deleting matches should reset the standings.")
+    testSuccess("Standings are kept separately for each tournament")
+
+
+def testQueryPlans():
+    """
+        Test the hot queries are planned without scanning whole tables.
+        Sequential scans are disabled since the planner prefers them on the
+        tiny test tables; any still planned mean no index serves the query.
+        Which index is picked, and how, is left to the planner.
+    """
+    plans = [
+        ('standings', 'player_standings', '''
+            SELECT id, name, wins, matches_played
+            FROM standings WHERE tourn = 1;'''),
+        ('roundComplete', 'player_standings', '''
+            SELECT min(matches_played) = max(matches_played)
+            FROM player_standings WHERE tourn = 1;'''),
+        ('hadBye', 'matches', '''
+            SELECT EXISTS (
+                SELECT * FROM matches
+                WHERE tourn = 1 AND player0 = 1 AND player1 IS NULL
+            );'''),
+        ('player1 matches', 'matches', '''
+            SELECT * FROM match_players WHERE tourn = 1 AND player = 1;'''),
+    ]
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute('SET enable_seqscan = off;')
+    for query, table, sql in plans:
+        cur.execute('EXPLAIN ' + sql)
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        if 'Seq Scan on %s ' % table in plan + ' ':
+            raise ValueError(
+                "%s query should not scan all of %s, got plan:\n%s" %
+                (query, table, plan))
+    conn.close()
+    testSuccess("Hot queries use indexes")
+
+
+def testRebuildStandings():
+    """
+        Test rebuildStandings recomputes standings that have drifted from the
+        recorded matches.
+    """
+    deleteMatches()
+    deleteTournamentPlayers()
+    deleteTournaments()
+    deletePlayers()
+    tournId = registerTournament('Classic Tournament')
+    playerIds = registerPlayers(['player 1', 'player 2', 'player 3'], tournId)
+    reportMatches(tournId, [(playerIds[0], playerIds[1]), (playerIds[2], None)])
+    expected = playerStandings(tournId)
+    conn = connect()
+    conn.cursor().execute(
+        'UPDATE player_standings SET wins = 7, matches_played = 9;')
+    conn.commit()
+    conn.close()
+    rebuildStandings(tournId)
+    if playerStandings(tournId, useCache=False) != expected:
+        raise ValueError("rebuildStandings should restore the standings.")
+    testSuccess("rebuildStandings recomputed standings from matches")
+
+
+def testStorageBackends():
+    """
+        Test a whole event runs the same way on the in-memory and SQLite
+        backends as on PostgreSQL.
+    """
+    for storage in (MemoryStorage(), SQLiteStorage()):
+        backend = type(storage).__name__
+        tournId = registerTournament('Simulated Tournament', storage)
+        playerIds = registerPlayers(
+            ['player %i' % i for i in range(9)], tournId, storage)
+        for round_ in range(1, 5):
+            pairs = swissPairings(tournId, storage, random.Random(round_))
+            if len(pairs) != 5:
+                raise ValueError(
+                    "%s gave %i pairs in round %i" %
+                    (backend, len(pairs), round_))
+            reportMatches(
+                tournId, [(pair[0], pair[2]) for pair in pairs], storage)
+        standings = playerStandings(tournId, storage)
+        if set(m for (i, n, w, m) in standings) != set([4]):
+            raise ValueError("%s should record 4 matches each" % backend)
+        if sum(w for (i, n, w, m) in standings) != 20:
+            raise ValueError("%s should record one win per pair" % backend)
+        try:
+            reportMatch(tournId, playerIds[0], playerIds[0], storage)
+        except (IntegrityError, sqlite3.IntegrityError):
+            pass
+        else:
+            raise ValueError("%s should reject invalid matches" % backend)
+        storage.close()
+    testSuccess("Events run on the in-memory and SQLite backends")
+
+
+def testPairingEdges():
+    """
+        Test the NumPy and pure Python edge builders give the same edges.
+    """
+    if numpy is None:
+        testSuccess("NumPy not installed, skipped comparing edge builders")
+        return
+    storage = MemoryStorage()
+    tournId = registerTournament('Simulated Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(31)], tournId, storage)
+    for round_ in range(1, 4):
+        pairs = swissPairings(tournId, storage, random.Random(round_))
+        reportMatches(tournId, [(pair[0], pair[2]) for pair in pairs], storage)
+    standings = playerStandings(tournId, storage)[1:]
+    played = playedPairs(tournId, storage)
+    edges = pairingEdges(standings, played, useNumpy=False)
+    if pairingEdges(standings, played, useNumpy=True) != edges:
+        raise ValueError("NumPy edges differ from pure Python edges.")
+    if len(edges) >= 30 * 29 // 2:
+        raise ValueError("Edges between players who played should be left out.")
+    testSuccess("NumPy and pure Python edge builders agree")
+
+
+def testSparsePairings():
+    """
+        Test pairing on a pruned graph gives pairings as good as pairing on
+        the full graph.
+    """
+    storage = MemoryStorage()
+    tournId = registerTournament('Simulated Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(40)], tournId, storage)
+    rng = random.Random(7)
+    for round_ in range(1, 6):
+        standings = dict(
+            (row.id, row) for row in playerStandings(tournId, storage))
+        def unfairness(pairs):
+            return sum(abs(standings[pair[0]].wins - standings[pair[2]].wins)
+                       for pair in pairs)
+        dense = swissPairings(tournId, storage)
+        sparse = swissPairings(
+            tournId, storage, maxBracketGap=0, topOpponents=2)
+        if len(sparse) != 20 or unfairness(sparse) != unfairness(dense):
+            raise ValueError(
+                "Pruned pairings in round %i are worse than full ones" %
+                round_)
+        rows = playerStandings(tournId, storage)
+        played = playedPairs(tournId, storage)
+        for gap, top in ((0, None), (1, None), (None, 2), (0, 2)):
+            kept, dropped = pruneEdges(
+                pairingEdges(rows, played), rows, gap, top)
+            if candidateEdges(rows, played, gap, top) != kept:
+                raise ValueError("Candidate edges differ from pruned edges.")
+        reportMatches(tournId, [
+            (pair[0], pair[2]) if rng.random() < 0.5 else (pair[2], pair[0])
+            for pair in sparse], storage)
+    testSuccess("Pruned pairings are as good as full pairings")
+
+
+def testScoreGroupPairings():
+    """
+        Test pairing score groups separately pairs everyone without
+        rematches, and keeps players within their score group where possible.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    storage = MemoryStorage()
+    tournId = registerTournament('Grouped Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(32)], tournId, storage)
+    rng = random.Random(11)
+    seen = set()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for round_ in range(1, 5):
+            wins = dict(
+                (row.id, row.wins) for row in playerStandings(tournId, storage))
+            pairs = swissPairings(
+                tournId, storage, strategy='groups', executor=executor)
+            paired = set(p[0] for p in pairs) | set(p[2] for p in pairs)
+            if len(pairs) != 16 or len(paired) != 32:
+                raise ValueError(
+                    "Score groups left players unpaired in round %i" % round_)
+            crossings = sum(wins[p[0]] != wins[p[2]] for p in pairs)
+            if crossings > len(set(wins.values())) - 1:
+                raise ValueError(
+                    "Too many pairings cross score groups in round %i" %
+                    round_)
+            for p in pairs:
+                key = frozenset((p[0], p[2]))
+                if key in seen:
+                    raise ValueError("Score groups paired a rematch.")
+                seen.add(key)
+            reportMatches(tournId, [
+                (p[0], p[2]) if rng.random() < 0.5 else (p[2], p[0])
+                for p in pairs], storage)
+    try:
+        swissPairings(tournId, storage, strategy='nearest')
+    except ValueError:
+        pass
+    else:
+        raise ValueError("An unknown pairing strategy should be rejected.")
+    testSuccess("Score groups are paired separately without rematches")
+
+
+def testPairingCache():
+    """
+        Test repeated pairings of an unchanged round come from the cache,
+        bye included, and that reporting or registering invalidates them.
+    """
+    storage = MemoryStorage()
+    tournId = registerTournament('Cached Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(9)], tournId, storage)
+    first = swissPairings(tournId, storage, rng=random.Random(1))
+    for seed in range(2, 12):
+        if swissPairings(tournId, storage, rng=random.Random(seed)) != first:
+            raise ValueError("Repeated pairings should come from the cache.")
+    if swissPairings(tournId, storage, useCache=False,
+                     rng=random.Random(5)) == first and \
+            swissPairings(tournId, storage, useCache=False,
+                          rng=random.Random(6)) == first:
+        raise ValueError("Uncached pairings should pick byes afresh.")
+    testSuccess("Repeated pairings come from the cache")
+    reportMatches(tournId, [(pair[0], pair[2]) for pair in first], storage)
+    second = swissPairings(tournId, storage)
+    if second == first:
+        raise ValueError("Reporting matches should invalidate the cache.")
+    registerPlayers(['player 9'], tournId, storage)
+    if len(pairingCache(storage)) != 0:
+        raise ValueError("Registering players should invalidate the cache.")
+    cache = PairingCache(maxEntries=2)
+    for tourn in range(3):
+        cache.put(tourn, 1, 0, (), [(1, 'a', 2, 'b')])
+    if len(cache) != 2 or cache.get(0, ()) is not None:
+        raise ValueError("The least recently used pairings should be evicted.")
+    generation = cache.generation(0)
+    cache.invalidate(0)
+    cache.put(0, 2, 0, (), [(1, 'a', 2, 'b')], generation)
+    if cache.get(0, ()) is not None:
+        raise ValueError("Pairings made before an invalidation were cached.")
+    testSuccess("Reports and registrations invalidate cached pairings")
+
+
+def testStandingsCache():
+    """
+        Test cached standings follow reported matches, and that roundComplete
+        tracks the least and most matches played.
+    """
+    storage = MemoryStorage()
+    tournId = registerTournament('Cached Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(7)], tournId, storage)
+    rng = random.Random(3)
+    for round_ in range(1, 4):
+        pairs = swissPairings(tournId, storage, rng)
+        for i, pair in enumerate(pairs):
+            if not roundComplete(tournId, storage) == (i == 0):
+                raise ValueError("roundComplete is wrong mid-round.")
+            reportMatch(tournId, pair[0], pair[2], storage)
+            if (playerStandings(tournId, storage) !=
+                    playerStandings(tournId, storage, useCache=False)):
+                raise ValueError("Cached standings differ from storage.")
+        if not roundComplete(tournId, storage):
+            raise ValueError("roundComplete should be true after a round.")
+    testSuccess("Cached standings follow reported matches")
+    standingsCache(storage).invalidate()
+    if (playerStandings(tournId, storage) !=
+            playerStandings(tournId, storage, useCache=False)):
+        raise ValueError("Standings should reload after invalidation.")
+    # Standings first loaded while a match is being written already count
+    # it, and must not count it again when the write is recorded.
+    tournId = registerTournament('Racing Tournament', storage)
+    first, second = registerPlayers(['first', 'second'], tournId, storage)
+    cache = standingsCache(storage)
+    generation = cache.generation(tournId)
+    storage.reportMatch(tournId, first, second)
+    playerStandings(tournId, storage)
+    cache.record(tournId, [(first, second)], generation)
+    if (playerStandings(tournId, storage) !=
+            playerStandings(tournId, storage, useCache=False)):
+        raise ValueError("A match written during a load was counted twice.")
+    # Loads run without the cache's lock, and standings loaded before a
+    # match recorded meanwhile are not cached.
+    tournId = registerTournament('Slow Tournament', storage)
+    first, second = registerPlayers(['first', 'second'], tournId, storage)
+
+    def slowLoad():
+        rows = playerStandings(tournId, storage, useCache=False)
+        generation = cache.generation(tournId)
+        storage.reportMatch(tournId, first, second)
+        cache.record(tournId, [(first, second)], generation)
+        return rows
+
+    cache.standings(tournId, slowLoad)
+    if (playerStandings(tournId, storage) !=
+            playerStandings(tournId, storage, useCache=False)):
+        raise ValueError("Standings loaded before a match were cached.")
+    testSuccess("Cached standings reload from storage")
+
+
+def testPairingScheduler():
+    """
+        Test the scheduler pairs tournaments like swissPairings, starting
+        queued jobs by deadline and then by tournament size.
+    """
+    from concurrent.futures import Future
+    from scheduler import PairingScheduler, SchedulerFull
+    storage = MemoryStorage()
+    tournIds = []
+    for size in (6, 4, 8, 5, 4):
+        tournId = registerTournament('Scheduled %i' % size, storage)
+        registerPlayers(['player %i' % i for i in range(size)], tournId,
+                        storage)
+        tournIds.append(tournId)
+
+    with PairingScheduler(maxWorkers=2) as scheduler:
+        futures = [scheduler.submit(tournId, storage, rng=random.Random(3),
+                                    useCache=False)
+                   for tournId in tournIds]
+        for tournId, future in zip(tournIds, futures):
+            expected = swissPairings(tournId, storage, rng=random.Random(3),
+                                     useCache=False)
+            if future.result() != expected:
+                raise ValueError(
+                    "Scheduled pairings differ from swissPairings.")
+    testSuccess("Scheduled pairings match swissPairings")
+
+    with PairingScheduler(maxWorkers=1) as scheduler:
+        pairs = scheduler.submit(tournIds[0], storage).result()
+        if swissPairings(tournIds[0], storage, rng=random.Random(4)) != pairs:
+            raise ValueError("Scheduled pairings should be cached.")
+        again = scheduler.submit(tournIds[0], storage)
+        if not again.done() or again.result() != pairs:
+            raise ValueError("The scheduler should reuse cached pairings.")
+    testSuccess("Scheduled pairings share the pairing cache")
+
+    class ManualExecutor(object):
+        def __init__(self):
+            self.jobs = []
+
+        def submit(self, fn, *args):
+            future = Future()
+            self.jobs.append((future, fn, args))
+            return future
+
+        def runNext(self):
+            future, fn, args = self.jobs.pop(0)
+            future.set_result(fn(*args))
+            return len(args[0])
+
+    executor = ManualExecutor()
+    scheduler = PairingScheduler(executor, maxWorkers=1, maxQueued=3)
+    scheduler.submit(tournIds[0], storage, useCache=False)
+    scheduler.submit(tournIds[1], storage, useCache=False)
+    scheduler.submit(tournIds[2], storage, useCache=False)
+    scheduler.submit(tournIds[3], storage, deadline=time.time() + 60,
+                     useCache=False)
+    try:
+        scheduler.submit(tournIds[4], storage, block=False, useCache=False)
+    except SchedulerFull:
+        pass
+    else:
+        raise ValueError("A full queue should refuse more jobs.")
+    order = [executor.runNext() for _ in range(4)]
+    if order != [6, 5, 8, 4]:
+        raise ValueError(
+            "Jobs ran in the wrong order: %r" % (order,))
+    scheduler.shutdown()
+    testSuccess("Queued pairings start by deadline, then size")
+
+    class BrokenExecutor(object):
+        def submit(self, fn, *args):
+            raise RuntimeError('Executor is broken')
+
+    scheduler = PairingScheduler(BrokenExecutor(), maxWorkers=1)
+    future = scheduler.submit(tournIds[0], storage, useCache=False)
+    if not isinstance(future.exception(timeout=1), RuntimeError):
+        raise ValueError("A job the executor refused should fail.")
+    scheduler.shutdown()
+    testSuccess("Jobs the executor refuses fail without blocking shutdown")
+
+
+def testBenchmark():
+    """
+        Test the benchmark times every stage of a small tournament, and
+        flags stages slower than the baseline.
+    """
+    import benchmark
+    results = benchmark.benchmark(MemoryStorage(), 9, 3, repeat=2)
+    names = [result['name'] for result in results]
+    if names != ['standings', 'edges', 'matching', 'swissPairings']:
+        raise ValueError("Benchmark timed the wrong stages: %r" % (names,))
+    baseline = [dict(result, min=result['min'] / 2) for result in results]
+    if not all(regressed for result, ratio, regressed in
+               benchmark.compare(results, baseline)):
+        raise ValueError("A doubled time should count as a regression.")
+    testSuccess("Benchmark times each pairing stage")
+
+
+def testMetrics():
+    """
+        Test a metrics registry sees the queries, timings and matching work
+        of a pairing, and that nothing is recorded once it is removed.
+    """
+    import metrics
+    storage = SQLiteStorage()
+    tournId = registerTournament('Measured Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(8)], tournId, storage)
+    registry = metrics.Registry()
+    metrics.setSink(registry)
+    try:
+        swissPairings(tournId, storage, useCache=False)
+    finally:
+        metrics.setSink(None)
+    counters = registry.counters()
+    for name in ('storage.queries', 'storage.rows', 'pairing.edges',
+                 'matching.calls', 'matching.stages',
+                 'matching.augmentations'):
+        if not counters.get(name):
+            raise ValueError("Metrics did not count %s." % name)
+    if counters['matching.augmentations'] != 4:
+        raise ValueError("Pairing 8 players should take 4 augmentations.")
+    if registry.timers()['tournament.swissPairings'].count != 1:
+        raise ValueError("Metrics did not time swissPairings.")
+    text = registry.prometheusText()
+    if 'tournament_storage_queries_total ' not in text:
+        raise ValueError("Prometheus text is missing the query counter.")
+    swissPairings(tournId, storage, useCache=False)
+    if registry.counters() != counters or mwmatching.STATS is not None:
+        raise ValueError("Metrics were recorded after the sink was removed.")
+    testSuccess("Metrics record queries, timings and matching work")
+
+
+def testRoundSnapshot():
+    """
+        Test a round snapshot holds the same standings, played pairs and
+        bye history as the separate queries, loaded in a single query.
+    """
+    import metrics
+    for storage in (MemoryStorage(), SQLiteStorage()):
+        tournId = registerTournament('Snapshot Tournament', storage)
+        registerPlayers(['player %i' % i for i in range(7)], tournId,
+                        storage)
+        rng = random.Random(5)
+        for round_ in range(2):
+            reportMatches(tournId, [
+                (p[0], p[2]) for p in swissPairings(tournId, storage, rng)],
+                storage)
+        registry = metrics.Registry()
+        metrics.setSink(registry)
+        try:
+            snapshot = roundSnapshot(tournId, storage)
+        finally:
+            metrics.setSink(None)
+        if registry.counters().get('storage.queries', 0) > 1:
+            raise ValueError("roundSnapshot should take a single query.")
+        if (snapshot.round != 3 or not snapshot.complete or
+                list(snapshot.standings) !=
+                list(playerStandings(tournId, storage, useCache=False)) or
+                snapshot.played != playedPairs(tournId, storage) or
+                snapshot.eligible != byeEligible(tournId, storage)):
+            raise ValueError("Snapshot differs from the separate queries.")
+        if not isinstance(snapshot.played, frozenset):
+            raise ValueError("Snapshots should be immutable.")
+    testSuccess("A round snapshot loads the round in one query")
+
+
+def testServerEdges():
+    """
+        Test pairing from edges built by the storage gives the same pairings
+        as building them in Python, and that pruned server edges still pair
+        everyone without rematches.
+    """
+    for storage in (MemoryStorage(), SQLiteStorage()):
+        tournId = registerTournament('Server Tournament', storage)
+        registerPlayers(['player %i' % i for i in range(11)], tournId,
+                        storage)
+        rng = random.Random(9)
+        seen = set()
+        for round_ in range(1, 6):
+            expected = swissPairings(tournId, storage, random.Random(round_),
+                                     useCache=False)
+            pairs = swissPairings(tournId, storage, random.Random(round_),
+                                  useCache=False, serverEdges=True)
+            if pairs != expected:
+                raise ValueError(
+                    "Server edges paired round %i differently." % round_)
+            pruned = swissPairings(tournId, storage, random.Random(round_),
+                                   maxBracketGap=0, useCache=False,
+                                   serverEdges=True)
+            paired = set(p[0] for p in pruned) | set(p[2] for p in pruned)
+            if len(pruned) != 6 or len(paired - set([None])) != 11:
+                raise ValueError("Pruned server edges left players unpaired.")
+            for p in pruned:
+                key = frozenset((p[0], p[2]))
+                if p[2] is not None and key in seen:
+                    raise ValueError("Pruned server edges paired a rematch.")
+            for p in pairs:
+                seen.add(frozenset((p[0], p[2])))
+            reportMatches(tournId, [
+                (p[0], p[2]) if p[2] is None or rng.random() < 0.5
+                else (p[2], p[0]) for p in pairs], storage)
+        # Both paths describe the round the same way, so their cached
+        # pairings do not evict each other.
+        cache = pairingCache(storage)
+        swissPairings(tournId, storage, random.Random(1))
+        swissPairings(tournId, storage, random.Random(1), serverEdges=True)
+        if (cache.get(tournId, (None, None, 'global', False)) is None or
+                cache.get(tournId, (None, None, 'global', True)) is None):
+            raise ValueError("Server edges evicted client pairings.")
+
+    class ChangedStorage(MemoryStorage):
+        def pairingEdges(self, tourn, excluded=None, maxBracketGap=None):
+            edges = MemoryStorage.pairingEdges(
+                self, tourn, excluded, maxBracketGap)
+            return edges + [(-1, edges[0][0], 0)]
+
+    storage = ChangedStorage()
+    tournId = registerTournament('Changed Tournament', storage)
+    registerPlayers(['player %i' % i for i in range(4)], tournId, storage)
+    try:
+        swissPairings(tournId, storage, useCache=False, serverEdges=True)
+    except RuntimeError:
+        pass
+    else:
+        raise ValueError("Edges of unknown players should be refused.")
+    testSuccess("Server-built edges give the same pairings")
+
+
+def testStreamingStandings():
+    """
+        Test standings streamed one row at a time, and exported to CSV and
+        JSON lines, match playerStandings.
+    """
+    import csv
+    import json
+    try:
+        # csv and json write native strings, bytes on Python 2.
+        from cStringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    for storage in (MemoryStorage(), SQLiteStorage()):
+        tournId = registerTournament('Streamed Tournament', storage)
+        registerPlayers(['player %i' % i for i in range(9)], tournId,
+                        storage)
+        reportMatches(tournId, [
+            (p[0], p[2]) for p in swissPairings(tournId, storage)], storage)
+        expected = [tuple(row) for row in
+                    playerStandings(tournId, storage, useCache=False)]
+        rows = iterStandings(tournId, storage, itersize=2)
+        if next(rows) != expected[0]:
+            raise ValueError("Streamed standings start with the wrong row.")
+        rows.close()
+        if list(iterStandings(tournId, storage, itersize=2)) != expected:
+            raise ValueError("Streamed standings differ from playerStandings.")
+        out = StringIO()
+        if exportStandings(tournId, out, 'csv', storage) != 9:
+            raise ValueError("exportStandings should count rows written.")
+        out.seek(0)
+        exported = [(int(row['id']), row['name'], int(row['wins']),
+                     int(row['matches_played']))
+                    for row in csv.DictReader(out)]
+        if exported != expected:
+            raise ValueError("CSV export differs from playerStandings.")
+        out = StringIO()
+        exportStandings(tournId, out, 'jsonl', storage)
+        exported = [json.loads(line) for line in out.getvalue().splitlines()]
+        if [(row['id'], row['name'], row['wins'], row['matches_played'])
+                for row in exported] != expected:
+            raise ValueError("JSON lines export differs from playerStandings.")
+    testSuccess("Standings stream and export without a full list")
+
+
+def testSession():
+    """
+        Test a session reuses its pooled connections and replaces ones that
+        have gone bad.
+    """
+    session = Session(minSize=1, maxSize=2, healthCheckInterval=0)
+    deleteMatches(session)
+    deleteTournamentPlayers(session)
+    deleteTournaments(session)
+    deletePlayers(session)
+    conn = session.getConn()
+    session.putConn(conn)
+    registerPlayer('player 1', session)
+    if countPlayers(session) != 1:
+        raise ValueError("Player registered through a session was not counted.")
+    reused = session.getConn()
+    if reused is not conn:
+        raise ValueError("Session should reuse its idle connection.")
+    testSuccess("Session reuses pooled connections.")
+    pid = reused.get_backend_pid()
+    session.putConn(reused)
+    admin = connect()
+    admin.cursor().execute('SELECT pg_terminate_backend(%s);', (pid,))
+    admin.close()
+    if countPlayers(session) != 1:
+        raise ValueError("Session should replace a dead connection.")
+    testSuccess("Session replaces connections that fail their health check.")
+    session.close()
+
+
 TEST_COUNT = 0
 def testSuccess(msg):
     global TEST_COUNT;
@@ -367,13 +1124,34 @@ def testSuccess(msg):
 
 
 if __name__ == '__main__':
+    mwmatching.CHECK_OPTIMUM = True
     testCount()
     testCountTounamentPlayers()
+    testRegisterPlayersInBulk()
     testStandingsBeforeMatches()
     testReportMatches()
+    testReportMatchesInBulk()
+    testStandingsPerTournament()
+    testRebuildStandings()
+    testQueryPlans()
     testPairings()
     testHaveAlreadyPlayed()
+    testPlayedPairs()
     testNoRematches()
     testHadBye()
+    testByeEligible()
     testAllowOddPlayers()
+    testSession()
+    testStorageBackends()
+    testPairingEdges()
+    testSparsePairings()
+    testScoreGroupPairings()
+    testPairingCache()
+    testStandingsCache()
+    testPairingScheduler()
+    testBenchmark()
+    testMetrics()
+    testRoundSnapshot()
+    testServerEdges()
+    testStreamingStandings()
     print "Success!  All tests pass!"